@@ -1,34 +1,42 @@
-import psycopg
-import requests 
-import datetime
-from datetime import datetime, timezone, timedelta
-from time import sleep 
+import httpx
 import logging
-from collections import defaultdict
+from datetime import date, timedelta
 import os
+import sys
+from common.http_cache import get_cache
+from common.scheduler import get_scheduler
 
 class CommitFetcher:
-    """API interface to fetch commits from GitHub. Aggregates commits for a given range of date, which is then used to pass to commit DB interface"""
+    """API interface to fetch commits from GitHub. Aggregates commits for a given range of date, which is then used to pass to commit DB interface.
+    Requests go through a shared httpx.AsyncClient so that fetches for different clients overlap instead of blocking the event loop.
+    Tokens, rate limits and retries are handled by the shared RequestScheduler (GITHUB_TOKENS)"""
     
-    TOKEN = '' ##СЮДА ТОКЕН
-    BASE_URL = 'https://api.github.com'
+    BASE_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
     HEADERS = {'X-GitHub-Api-Version': '2022-11-28',
-                        'accept': 'application/vnd.github+json',
-                        'Authorization': f"Bearer {TOKEN}"
+                        'accept': 'application/vnd.github+json'
                     }
+    TIMEOUT = float(os.getenv('GITHUB_TIMEOUT', 10))
     
-    def fetch_commits(self, owner, repo, since, until) -> list[dict]:
-        
+    def __init__(self, client: httpx.AsyncClient, budget=None) -> None:
+        self.client = client
+        self.budget = budget #optional RateBudget shared with other fetchers
+    
+    @classmethod
+    def create_client(cls) -> httpx.AsyncClient:
+        """Keep-alive client shared by all requests of the app"""
+        return httpx.AsyncClient(headers=cls.HEADERS, timeout=cls.TIMEOUT)
+    
+    async def fetch_pages(self, owner, repo, since, until):
+        """Yields the commits of the inclusive day range [since, until] (UTC) one page at a time, newest first"""
         url = f"{self.BASE_URL}/repos/{owner}/{repo}/commits"
-        params = {"since": since, "until": until, "per_page": 100}
-        commits = []
+        params = {"since": f"{since}T00:00:00Z", "until": f"{until}T23:59:59Z", "per_page": 100}
 
         while url:
-            sleep(1)
-            response = requests.get(url, headers=self.HEADERS, params=params)
+            if self.budget:
+                await self.budget.acquire()
+            response = await get_scheduler().arequest(self.client, 'GET', url, params=params)
             response.raise_for_status()
-            page_commits = response.json()
-            commits.extend(page_commits)
+            yield response.json()
             
             links = response.headers.get('Link')
             if links:
@@ -39,47 +47,45 @@ class CommitFetcher:
                         break
             else:
                 url = None
-                
-        return commits if commits else (since,until)
-
-    def aggregate_commits(self, commits: list) -> list[dict]:
-        """Parses a dictionary with detailed info on commits within a specific range,
-        then returns an array with date, commits, [authors] as keys."""
-        aggregated_data = defaultdict(lambda: {'commits': 0, 'authors': set()}) 
-        if isinstance(commits, tuple):
-            since, until = commits
-            dates_between = self.list_dates_between(since, until)
-            return [
-                {"date": date, "commits": 0, "authors": []}
-                for date in dates_between
-                ]
+            params = None #next links already carry the query string
         
-        for commit in commits:
-            commit_date = commit['commit']['author']['date']
-            author = commit['commit']['author']['name']
-            aggregated_data[commit_date]['commits'] += 1
-            aggregated_data[commit_date]['authors'].add(author)
+        logging.info(f'HTTP cache stats: {get_cache().stats()}, scheduler stats: {get_scheduler().stats()}')
 
+    def aggregate_commits(self, commits: list, aggregated_data: dict) -> dict:
+        """Folds a page of detailed commits into per-day counters and author sets, keyed by yyyy-mm-dd.
+        Commits are bucketed by the day of their committer date, which is the date GitHub filters since/until on,
+        so every row lands inside the fetched range."""
+        for commit in commits:
+            commit_date = commit['commit']['committer']['date'][:10]
+            author = sys.intern(commit['commit']['author']['name']) #one string object per author across all days
+            day = aggregated_data.setdefault(commit_date, {'commits': 0, 'authors': set()})
+            day['commits'] += 1
+            day['authors'].add(author)
+        return aggregated_data
+    
+    def pop_days(self, aggregated_data: dict, after: str = '') -> list[dict]:
+        """Removes and returns the days newer than `after` as an array with date, commits, [authors] as keys"""
+        finished = [date for date in aggregated_data if date > after]
         return [
-            {"date": date, "commits": data['commits'], "authors": list(data['authors'])}
-            for date, data in aggregated_data.items()
-        ] 
-        
-    def get_commits(self, owner, repo, since, until):
+            {"date": date, "commits": aggregated_data[date]['commits'], "authors": list(aggregated_data.pop(date)['authors'])}
+            for date in finished
+        ]
+    
+    async def stream_commits(self, owner, repo, since, until):
+        """Streams aggregated days of [since, until] as (days, finished_from) after every page.
+        GitHub lists commits newest first, so once a page reaches day D every day after D is finished and gets yielded,
+        finished_from being the first of those days. Only unfinished days are held in memory, whatever the length of the range.
+        Commits that arrive out of order for an already yielded day are yielded again and must be added to the stored row"""
         logging.info(f'Getting commits for {repo} since {since} until {until}...')
+        aggregated_data = {}
+        watermark = f"{until}"
         
-        commits = self.fetch_commits(owner, repo, since, until)
-        agg_commits = self.aggregate_commits(commits)
-        return agg_commits
-    
-    
-    def list_dates_between(self, start_date: str, end_date: str) -> list:
-        start_date = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc)
-        end_date = datetime.combine(end_date, datetime.min.time()).replace(tzinfo=timezone.utc)    
-        date_list = []
-        current_date = start_date
-        while current_date <= end_date:
-            date_list.append(str(current_date))
-            current_date += timedelta(days=1)
-        return date_list
-
+        async for page in self.fetch_pages(owner, repo, since, until):
+            if not page:
+                continue
+            self.aggregate_commits(page, aggregated_data)
+            watermark = min(watermark, *(commit['commit']['committer']['date'][:10] for commit in page))
+            finished_from = date.fromisoformat(watermark) + timedelta(days=1)
+            yield self.pop_days(aggregated_data, after=watermark), max(finished_from, since)
+        
+        yield self.pop_days(aggregated_data), since
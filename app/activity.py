@@ -0,0 +1,92 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+import asyncio
+import logging
+import os
+from psycopg_pool import AsyncConnectionPool
+from app.db import DBInterface
+from app.CommitFetcher import CommitFetcher
+from app.singleflight import SingleFlight
+from common.migrations import next_month
+
+
+def period_bounds(granularity: str, since: date, until: date, today: date) -> Tuple[date, date]:
+    """Widens [since, until] to whole weeks (ISO, starting Monday) or months, capped at today, so every returned rollup is complete"""
+    if granularity == 'week':
+        start = since - timedelta(days=since.weekday())
+        end = until + timedelta(days=6 - until.weekday())
+    else:
+        start = since.replace(day=1)
+        end = next_month(until.replace(day=1)) - timedelta(days=1)
+    return start, min(end, today)
+
+
+TODAY_TTL = float(os.getenv('ACTIVITY_TODAY_TTL', 1800)) #seconds the current day is served from Postgres after a fetch, at least SYNC_INTERVAL
+LOCK_WAIT = float(os.getenv('ACTIVITY_LOCK_WAIT', 10)) #seconds a request waits for another process fetching the same repo
+BATCH_CONCURRENCY = int(os.getenv('ACTIVITY_BATCH_CONCURRENCY', max(1, DBInterface.POOL_MAX_SIZE // 2))) #below the pool size, each fetch holds a connection
+
+
+async def missing_ranges(db: DBInterface, owner, repo, since: date, until: date, today_ttl: float) -> List[Tuple[date, date]]:
+    """Uncovered sub-ranges of [since, until], except the current day when it was fetched within today_ttl seconds"""
+    ranges = await db.get_uncovered_ranges(owner, repo, since, until)
+    today = datetime.now(tz=timezone.utc).date()
+    if ranges and ranges[-1][1] >= today and await db.is_today_fresh(f"{owner}/{repo}", today_ttl):
+        start, _ = ranges.pop()
+        if start < today:
+            ranges.append((start, today - timedelta(days=1)))
+    return ranges
+
+
+async def fetch_missing(db: DBInterface, fetcher: CommitFetcher, owner, repo, since: date, until: date,
+                        today_ttl: float = TODAY_TTL, lock_wait: float = LOCK_WAIT) -> int:
+    """Fetches the sub-ranges of [since, until] missing from commit_coverage, one GitHub range per contiguous gap.
+    Days without commits are covered too, so quiet repos are not fetched again. The current day is never covered,
+    it is fetched again once its last fetch is older than today_ttl. Returns the number of fetched ranges.
+    Fetches of one repo are serialized across processes by an advisory lock, the lock is per repo rather than per range
+    because overlapping ranges would otherwise add the same commits twice. Coverage is checked again once the lock is held,
+    so a process that waited for another one only fetches what is still missing. The lock is waited for at most lock_wait
+    seconds (a throttled sync of the repo can hold it for minutes), then RuntimeError is raised"""
+    repo_full_name = f"{owner}/{repo}"
+    if not await missing_ranges(db, owner, repo, since, until, today_ttl):
+        return 0
+
+    if not await db.lock_repo(repo_full_name, lock_wait):
+        raise RuntimeError(f'{repo_full_name} is being fetched by another process')
+    try:
+        ranges = await missing_ranges(db, owner, repo, since, until, today_ttl)
+        if ranges:
+            logging.info(f'Fetching {len(ranges)} missing range(s) of {repo_full_name}: {ranges}')
+
+        last_complete_day = datetime.now(tz=timezone.utc).date() - timedelta(days=1) #today can still get new commits
+        for start, end in ranges:
+            fetched_at = datetime.now(tz=timezone.utc) #commits after this moment may be missing from the fetch
+            await db.clear_commits(owner, repo, start, end)
+            async for days, finished_from in fetcher.stream_commits(owner, repo, start, end):
+                #finished days are flushed and covered page by page, an interrupted fetch keeps them
+                await db.store_aggregated_commits(owner, repo, days, covered=(finished_from, min(end, last_complete_day)))
+            if end > last_complete_day:
+                await db.set_today_fetched(repo_full_name, fetched_at)
+        return len(ranges)
+    finally:
+        await db.unlock_repo(repo_full_name)
+
+
+async def fetch_missing_once(pool: AsyncConnectionPool, fetcher: CommitFetcher, flights: SingleFlight, owner, repo, since: date, until: date) -> int:
+    """fetch_missing deduplicated per (repo, range): concurrent identical requests share one fetch.
+    The fetch borrows its own connection, so it outlives a caller that goes away. Callers must not hold a pool connection
+    while awaiting it, or enough concurrent waiters exhaust the pool and the fetch never gets one"""
+    async def fetch() -> int:
+        async with pool.connection() as conn:
+            return await fetch_missing(DBInterface(conn), fetcher, owner, repo, since, until)
+    return await flights.do((f"{owner}/{repo}", since, until), fetch)
+
+
+_batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+async def fetch_missing_many(pool: AsyncConnectionPool, fetcher: CommitFetcher, flights: SingleFlight, ranges: Dict[str, Tuple[date, date]]) -> None:
+    """fetch_missing_once for {repo: (since, until)}. At most BATCH_CONCURRENCY fetches run at a time across all batch requests,
+    so a batch neither drains the connection pool nor bursts GitHub"""
+    async def fetch(repo_full_name, since, until) -> int:
+        async with _batch_slots:
+            return await fetch_missing_once(pool, fetcher, flights, *repo_full_name.split('/', 1), since, until)
+    await asyncio.gather(*[fetch(repo_full_name, since, until) for repo_full_name, (since, until) in ranges.items()])
@@ -1,16 +1,41 @@
-from fastapi import FastAPI, Query, Depends
+from fastapi import FastAPI, Query, Depends, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 import app.models as models
-from typing import List, Annotated, Tuple
+from typing import Dict, List, Annotated, Optional, Tuple, Union
+from urllib.parse import urlencode
 from datetime import datetime, timedelta, timezone
 from fastapi.exceptions import HTTPException
 from app.db import DBInterface
 from app.CommitFetcher import CommitFetcher
+from app.cache import ResponseCache
+from app.activity import TODAY_TTL, fetch_missing_many, fetch_missing_once, period_bounds
+from app.singleflight import SingleFlight
+from app.sync import SyncWorker
 import logging 
+import asyncio
+from contextlib import asynccontextmanager
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.pool = await DBInterface.create_pool()
+    app.state.http_client = CommitFetcher.create_client()
+    app.state.response_cache = ResponseCache()
+    app.state.flights = SingleFlight()
+    app.state.sync_worker = SyncWorker(app.state.pool, app.state.http_client)
+    tasks = [asyncio.create_task(app.state.response_cache.listen(DBInterface.CONN_DETAILS))]
+    if SyncWorker.ENABLED:
+        tasks.append(asyncio.create_task(app.state.sync_worker.run()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await app.state.http_client.aclose()
+        await app.state.pool.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="client/static"), name="static")
 
@@ -21,20 +46,102 @@ async def root():
 
 
 @app.get('/api/repos/top100', response_model=List[models.Repository])
-async def getTop100(db: DBInterface = Depends(models.get_db)):
-    top100_raw = db.get_top100()
-    top100 = models.repos_to_pydantic(top100_raw)
-    return top100
+async def getTop100(request: Request):
+    """Served from the in-process cache, the DB is only queried after the parser committed a new snapshot"""
+    cache = request.app.state.response_cache
+    entry = cache.get('top100')
+    if entry is None:
+        generation = cache.generation
+        async with request.app.state.pool.connection() as conn:
+            top100_raw = await DBInterface(conn).get_top100()
+        entry = cache.set('top100', models.repos_to_json(top100_raw), generation)
+    return cache.response(entry, request)
+
+@app.get('/api/repos', response_model=List[models.Repository])
+async def getRepos(request: Request,
+                   limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+                   after: Annotated[int, Query(ge=0)] = 0,
+                   language: Optional[str] = None,
+                   db: DBInterface = Depends(models.get_db)):
+    """Ranked repos in pages of `limit`, after the position `after` (keyset pagination). When the page is full,
+    the Link header holds the URL of the next page, like GitHub does"""
+    repos_raw = await db.get_repos(limit, after, language)
+    headers = {}
+    if len(repos_raw) == limit:
+        next_params = {'limit': limit, 'after': repos_raw[-1]['position_cur']}
+        if language:
+            next_params['language'] = language
+        headers['Link'] = f'<{request.url.path}?{urlencode(next_params)}>; rel="next"'
+    return Response(content=models.repos_to_json(repos_raw), media_type='application/json', headers=headers)
+
+@app.get('/api/repos/history', response_model=Dict[str, List[models.RankPoint]])
+async def getRankHistoryMulti(repos: Annotated[List[str], Query(max_length=100)],
+                              date_range: Tuple[datetime, datetime] = Depends(models.query_params),
+                              resolution: models.resolutionParam = 'day',
+                              db: DBInterface = Depends(models.get_db)):
+    """Rank history of several repos (?repos=owner/repo&repos=...), repos without snapshots in the range are omitted"""
+    since_date, until_date, _ = date_range
+    history_raw = await db.get_rank_history(repos, since_date, until_date, resolution)
+    return models.history_to_pydantic(history_raw)
+
+@app.get('/api/repos/activity', response_model=models.ActivityColumns)
+async def getActivityMulti(request: Request,
+                           repos: Annotated[List[str], Query(max_length=100)],
+                           date_range: Tuple[datetime, datetime] = Depends(models.query_params),
+                           commit_fetcher: CommitFetcher = Depends(models.get_commit_fetcher)):
+    """Daily commit counts of several repos (?repos=owner/repo&repos=...) in columnar form: one dates array and a count array per repo.
+    Coverage is checked for all repos in one query, only repos with gaps are fetched (a few at a time), counts are read in one query.
+    Days before a repo was created are reported as 0. No connection is held while the fetches run"""
+    since_date, until_date, _ = date_range
+    repos = list(dict.fromkeys(repos))
+
+    async with models.pooled_db(request) as db:
+        creations = await db.get_repo_creations(repos)
+    unknown = [repo for repo in repos if repo not in creations]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Given repositories cannot be found in top 100: {', '.join(unknown)}")
+
+    ranges = {repo: (max(since_date, created), until_date) for repo, created in creations.items() if created <= until_date}
+    for repo in ranges:
+        request.app.state.sync_worker.record_request(repo)
+    try:
+        async with models.pooled_db(request) as db:
+            uncovered = await db.get_uncovered_repos(ranges, TODAY_TTL) if ranges else []
+        await fetch_missing_many(request.app.state.pool, commit_fetcher, request.app.state.flights, {repo: ranges[repo] for repo in uncovered})
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Possibly, Github API is not responding, token might be expired. Try again later. {e}")
+
+    async with models.pooled_db(request) as db:
+        counts_raw = await db.get_commit_counts(repos, since_date, until_date)
+    return Response(content=models.counts_to_json(repos, since_date, until_date, counts_raw), media_type='application/json')
 
-@app.get('/api/repos/{owner}/{repo}/activity', response_model = List[models.RepoActivity])
-async def getRepoActivity(owner: str, 
+@app.get('/api/repos/{owner}/{repo}/history', response_model=List[models.RankPoint])
+async def getRankHistory(owner: str,
+                         repo: str,
+                         date_range: Tuple[datetime, datetime] = Depends(models.query_params),
+                         resolution: models.resolutionParam = 'day',
+                         db: DBInterface = Depends(models.get_db)):
+    
+    since_date, until_date, _ = date_range
+    if not await db.get_repo_creation(owner, repo):
+        raise HTTPException(status_code=404, detail='Given repository cannot be found in top 100. Possibly, there was a type in your request.')
+    
+    history_raw = await db.get_rank_history([f"{owner}/{repo}"], since_date, until_date, resolution)
+    return models.history_to_pydantic(history_raw).get(f"{owner}/{repo}", [])
+
+@app.get('/api/repos/{owner}/{repo}/activity', response_model = Union[List[models.RepoActivity], List[models.ActivityRollup]])
+async def getRepoActivity(request: Request,
+                          owner: str, 
                           repo: str, 
                           date_range: Tuple[datetime, datetime] = Depends(models.query_params),
-                          db: DBInterface = Depends(models.get_db)):
-    
+                          granularity: models.granularityParam = 'day',
+                          commit_fetcher: CommitFetcher = Depends(models.get_commit_fetcher)):
+    """No connection is held while awaiting the fetch, which needs one of its own"""
     since_date, until_date, current_date = date_range   
     
-    repo_creation_date = db.get_repo_creation(owner, repo)
+    async with models.pooled_db(request) as db:
+        repo_creation_date = await db.get_repo_creation(owner, repo)
 
     if repo_creation_date:
         if since_date < repo_creation_date or until_date < repo_creation_date:
@@ -42,34 +149,90 @@ async def getRepoActivity(owner: str,
     else:
         raise HTTPException(status_code=404, detail='Given repository cannot be found in top 100. Possibly, there was a type in your request.')
     
-    commit_fetcher = CommitFetcher()
-
-    existing_dates = db.get_existing_commits(owner, repo, since_date, until_date)
-
-    existing_dates = set(existing_dates)
-    all_dates = {since_date + timedelta(days=x) for x in range((until_date - since_date).days + 1)}
-    missing_dates = all_dates.difference(existing_dates)
-
-    if missing_dates:
-        if all_dates == missing_dates:
-            try:
-                aggregated_commits = commit_fetcher.get_commits(owner, repo, since_date-timedelta(days=1), until_date)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Possibly, Github API is not responding, token might be expired. Try again later. {e} ")
-            db.store_aggregated_commits(owner, repo, aggregated_commits)
-        else:
-            for date in missing_dates:
-                prev_date = date - timedelta(days=1)
-                try:
-                    aggregated_commits = commit_fetcher.get_commits(owner, repo, prev_date, date)
-                except Exception as e:
-                    logging.error(e)
-                    raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Github API is not responding, token might be expired. Try again later {e}")
-                db.store_aggregated_commits(owner, repo, aggregated_commits)
-
-    # Fetch the aggregated commit activity from the database
-    activity_raw = db.get_aggregated_commit_activity(owner, repo, since_date, until_date)
+    request.app.state.sync_worker.record_request(f"{owner}/{repo}")
+    if granularity != 'day': #wide ranges are answered from the weekly/monthly rollups
+        since_date, until_date = period_bounds(granularity, since_date, until_date, current_date)
+    try:
+        await fetch_missing_once(request.app.state.pool, commit_fetcher, request.app.state.flights, owner, repo, since_date, until_date)
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Possibly, Github API is not responding, token might be expired. Try again later. {e}")
+
+    async with models.pooled_db(request) as db:
+        if granularity != 'day':
+            rollups_raw = await db.get_commit_rollups(owner, repo, granularity, since_date, until_date)
+            return Response(content=models.rollups_to_json(rollups_raw), media_type='application/json')
+
+        # Fetch the aggregated commit activity from the database
+        activity_raw = await db.get_aggregated_commit_activity(owner, repo, since_date, until_date)
+    if not activity_raw: #no commits in the whole range, return every date with empty fields
+        activity_raw = [{'date': since_date + timedelta(days=x), 'commits': 0, 'authors': []} for x in range((until_date - since_date).days + 1)]
     
-    activity = models.activity_to_pydantic(activity_raw)
+    return Response(content=models.activity_to_json(activity_raw), media_type='application/json')
+
+@app.get('/api/repos/{owner}/{repo}/contributors', response_model=models.ContributorCount)
+async def getRepoContributors(request: Request,
+                              owner: str,
+                              repo: str,
+                              date_range: Tuple[datetime, datetime] = Depends(models.query_params),
+                              commit_fetcher: CommitFetcher = Depends(models.get_commit_fetcher)):
+    """Number of distinct commit authors over the whole range"""
+    since_date, until_date, current_date = date_range
+
+    async with models.pooled_db(request) as db:
+        repo_creation_date = await db.get_repo_creation(owner, repo)
+    if not repo_creation_date:
+        raise HTTPException(status_code=404, detail='Given repository cannot be found in top 100. Possibly, there was a type in your request.')
+    if since_date < repo_creation_date:
+        raise HTTPException(status_code=403, detail=f"Invalid datarange specified: provide a range between {repo_creation_date} and {current_date}.")
+
+    request.app.state.sync_worker.record_request(f"{owner}/{repo}")
+    try:
+        await fetch_missing_once(request.app.state.pool, commit_fetcher, request.app.state.flights, owner, repo, since_date, until_date)
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Possibly, Github API is not responding, token might be expired. Try again later. {e}")
+
+    async with models.pooled_db(request) as db:
+        authors_count = await db.count_distinct_authors(owner, repo, since_date, until_date)
+    return models.ContributorCount(since=since_date, until=until_date, authors_count=authors_count)
+
+
+@app.get('/api/repos/{owner}/{repo}/activity/stream')
+async def getRepoActivityStream(request: Request,
+                                owner: str,
+                                repo: str,
+                                date_range: Tuple[datetime, datetime] = Depends(models.query_params),
+                                commit_fetcher: CommitFetcher = Depends(models.get_commit_fetcher)):
+    """Daily activity as NDJSON (one RepoActivity per line), streamed from a server-side cursor in batches.
+    Time to first byte and memory per request do not depend on the range size. Like the activity endpoint,
+    a range without commits yields every date with empty fields"""
+    since_date, until_date, current_date = date_range
+
+    async with models.pooled_db(request) as db:
+        repo_creation_date = await db.get_repo_creation(owner, repo)
+    if not repo_creation_date:
+        raise HTTPException(status_code=404, detail='Given repository cannot be found in top 100. Possibly, there was a type in your request.')
+    if since_date < repo_creation_date:
+        raise HTTPException(status_code=403, detail=f"Invalid datarange specified: provide a range between {repo_creation_date} and {current_date}.")
+
+    request.app.state.sync_worker.record_request(f"{owner}/{repo}")
+    try:
+        await fetch_missing_once(request.app.state.pool, commit_fetcher, request.app.state.flights, owner, repo, since_date, until_date)
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail=f"An unknown error occurred on the server. Possibly, Github API is not responding, token might be expired. Try again later. {e}")
+
+    async def stream():
+        #the stream borrows its own connection for as long as the body is being sent
+        async with request.app.state.pool.connection() as conn:
+            empty = True
+            async for rows in DBInterface(conn).stream_aggregated_commit_activity(owner, repo, since_date, until_date):
+                empty = False
+                yield models.activity_to_ndjson(rows)
+        if empty:
+            days = (until_date - since_date).days + 1
+            for start in range(0, days, DBInterface.STREAM_BATCH_SIZE):
+                yield models.activity_to_ndjson({'date': since_date + timedelta(days=x), 'commits': 0, 'authors': []} for x in range(start, min(days, start + DBInterface.STREAM_BATCH_SIZE)))
 
-    return activity
\ No newline at end of file
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
@@ -0,0 +1,61 @@
+import psycopg
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+from fastapi import Request, Response
+
+
+class ResponseCache:
+    """In-process cache of serialized responses with strong ETags.
+    The parser sends NOTIFY on CHANNEL when it commits a new snapshot, every uvicorn worker listens on its own connection
+    and drops its entries, so workers never serve a list older than the last committed refresh."""
+    CHANNEL = 'repositories_changed'
+    RECONNECT_DELAY = 5
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, Tuple[bytes, str]] = {}
+        self.generation = 0
+        self.listening = False #nothing is stored while invalidations cannot be received
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        return self.entries.get(key)
+
+    def set(self, key: str, body: bytes, generation: int) -> Tuple[bytes, str]:
+        """Stores a body rendered from data read at `generation`. Stale renders that raced with an invalidation are returned but not stored"""
+        entry = (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+        if self.listening and generation == self.generation:
+            self.entries[key] = entry
+        return entry
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+
+    def response(self, entry: Tuple[bytes, str], request: Request) -> Response:
+        """Full response, or 304 if the client already holds this ETag"""
+        body, etag = entry
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    async def listen(self, conn_details: str) -> None:
+        """Runs for the lifetime of the app. Invalidates on every notification, and after reconnecting since notifications may have been missed"""
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conn_details, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.CHANNEL};")
+                    self.invalidate()
+                    self.listening = True
+                    async for _ in conn.notifies():
+                        logging.info('Repositories changed, dropping cached responses')
+                        self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Lost {self.CHANNEL} listener connection: {e}. Reconnecting...')
+                self.listening = False
+                self.invalidate()
+                await asyncio.sleep(self.RECONNECT_DELAY)
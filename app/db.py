@@ -1,108 +1,393 @@
+import asyncio
 import psycopg
+from psycopg.rows import dict_row
+from psycopg.types.range import Range
+from psycopg_pool import AsyncConnectionPool
 from dateutil.parser import isoparse
 import logging
-from datetime import date
-from typing import List, Tuple, Optional
+from datetime import date, datetime, time, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Tuple, Optional
 import os
+from common.migrations import migrate
 
 class DBInterface:
-    """Interface for commits API endpoint to communicate with the DB."""
+    """Async interface for the API endpoints to communicate with the DB. Wraps a connection borrowed from the process-wide pool."""
     CONN_DETAILS = os.getenv('CONN_DETAILS')
+    POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+    POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+    POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300)) #seconds before an idle connection above min_size is closed
+    POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)) #seconds before a connection is recycled
+    STREAM_BATCH_SIZE = int(os.getenv('DB_STREAM_BATCH_SIZE', 1000)) #rows per fetch of a server-side cursor
+    LOCK_POLL = 0.2 #seconds between attempts to take a repo lock
+    AUTHOR_IDS: Dict[str, int] = {} #process-wide cache of the authors dictionary, ids never change
     
-    def __init__(self) -> None:
-
+    def __init__(self, conn: psycopg.AsyncConnection) -> None:
+        self.conn = conn
+    
+    @classmethod
+    async def create_pool(cls) -> AsyncConnectionPool:
+        """Applies pending schema migrations, then opens the connection pool. Connections are health checked on checkout"""
         logging.basicConfig(level=logging.INFO)
-
+        
         try:
-            self.conn = psycopg.connect(self.CONN_DETAILS)
+            with psycopg.connect(cls.CONN_DETAILS) as conn: #runs once before the app starts serving
+                migrate(conn)
+            pool = AsyncConnectionPool(cls.CONN_DETAILS,
+                                       min_size=cls.POOL_MIN_SIZE,
+                                       max_size=cls.POOL_MAX_SIZE,
+                                       max_idle=cls.POOL_MAX_IDLE,
+                                       max_lifetime=cls.POOL_MAX_LIFETIME,
+                                       check=AsyncConnectionPool.check_connection,
+                                       open=False)
+            await pool.open(wait=True)
         except Exception as e:
             logging.error(f'Error occurred when connecting to a DB: {e}')
             raise RuntimeError(f'Error occurred when connecting to a DB: {e}')
-        
-        with self.conn.cursor() as cursor:
-            try:
-                self.create_table(cursor)
-                self.conn.commit()
-            except Exception as e:
-                self.conn.rollback()
-                raise RuntimeError(f"Error initializing agg_commits: {e}")
-        
-    def create_table(self, cursor):
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS agg_commits (
-                repo TEXT NOT NULL,
-                commit_date DATE NOT NULL,
-                commits INT NOT NULL,
-                authors TEXT[] NOT NULL,
-                PRIMARY KEY (repo, commit_date),
-                FOREIGN KEY (repo) REFERENCES repositories(repo) ON DELETE CASCADE
-            );
-        """)
-    
-    def get_existing_commits(self, owner, repo, since, until) -> list:
+        return pool
+    
+    async def get_uncovered_ranges(self, owner, repo, since, until) -> List[Tuple[date, date]]:
+        """Inclusive sub-ranges of [since, until] that were never fetched from GitHub, oldest first"""
         repo_full_name = f"{owner}/{repo}"
-        with self.conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT DISTINCT commit_date
-                FROM agg_commits
-                WHERE repo = %s AND commit_date BETWEEN %s AND %s
-                ORDER BY commit_date;
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT lower(r), upper(r) - 1
+                FROM unnest(
+                    datemultirange(daterange(%(since)s, %(until)s, '[]')) - COALESCE((
+                        SELECT range_agg(covered)
+                        FROM commit_coverage
+                        WHERE repo = %(repo)s AND covered && daterange(%(since)s, %(until)s, '[]')
+                    ), '{}'::datemultirange)
+                ) AS r
+                ORDER BY 1;
+            """, {'repo': repo_full_name, 'since': since, 'until': until})
+            return await cursor.fetchall()
+    
+    async def get_uncovered_repos(self, ranges: Dict[str, Tuple[date, date]], today_ttl: float) -> List[str]:
+        """Repos of {repo: (since, until)} with at least one day of their range never fetched, checked in a single query.
+        The current UTC day is never covered, it only counts as missing once its last fetch is older than today_ttl seconds"""
+        repos = list(ranges)
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT t.repo
+                FROM unnest(%(repos)s::text[], %(since)s::date[], %(until)s::date[]) AS t(repo, since, until)
+                LEFT JOIN sync_state s ON s.repo = t.repo
+                CROSS JOIN LATERAL (
+                    SELECT CASE WHEN s.today_fetched_at >= greatest(date_trunc('day', now(), 'UTC'), now() - make_interval(secs => %(ttl)s))
+                                THEN least(t.until, (now() AT TIME ZONE 'UTC')::date - 1)
+                                ELSE t.until END AS until
+                ) AS e
+                WHERE e.until >= t.since
+                  AND NOT datemultirange(daterange(t.since, e.until, '[]')) <@ COALESCE((
+                    SELECT range_agg(c.covered)
+                    FROM commit_coverage c
+                    WHERE c.repo = t.repo AND c.covered && daterange(t.since, e.until, '[]')
+                  ), '{}'::datemultirange);
+            """, {'repos': repos, 'since': [ranges[repo][0] for repo in repos], 'until': [ranges[repo][1] for repo in repos], 'ttl': today_ttl})
+            return [row[0] for row in await cursor.fetchall()]
+    
+    async def add_coverage(self, cursor, repo_full_name, start, end):
+        """Records [start, end] as fetched, merged with every overlapping or adjacent interval of the repo into one row.
+        Two concurrent merges can leave overlapping rows behind, which range_agg in get_uncovered_ranges tolerates"""
+        await cursor.execute("""
+            WITH removed AS (
+                DELETE FROM commit_coverage
+                WHERE repo = %(repo)s AND (covered && %(range)s OR covered -|- %(range)s)
+                RETURNING covered
+            )
+            INSERT INTO commit_coverage (repo, covered)
+            SELECT %(repo)s, range_merge(range_agg(r))
+            FROM (SELECT covered AS r FROM removed UNION ALL SELECT %(range)s) AS ranges;
+        """, {'repo': repo_full_name, 'range': Range(start, end, '[]')})
+    
+    async def lock_repo(self, repo_full_name, wait: float) -> bool:
+        """Session advisory lock serializing GitHub fetches of a repo across all processes. Retried for up to wait seconds,
+        without blocking in Postgres, returns whether it was taken"""
+        deadline = asyncio.get_running_loop().time() + wait
+        while True:
+            cursor = await self.conn.execute("SELECT pg_try_advisory_lock(hashtextextended(%s, 0));", (repo_full_name,))
+            locked = (await cursor.fetchone())[0]
+            await self.conn.commit()
+            if locked or asyncio.get_running_loop().time() >= deadline:
+                return locked
+            await asyncio.sleep(self.LOCK_POLL)
+    
+    async def unlock_repo(self, repo_full_name):
+        await self.conn.rollback() #a failed fetch can leave the transaction aborted
+        await self.conn.execute("SELECT pg_advisory_unlock(hashtextextended(%s, 0));", (repo_full_name,))
+        await self.conn.commit()
+    
+    async def clear_commits(self, owner, repo, since, until):
+        """Drops the rows of a range that is about to be fetched again, they can only be partial since the range is not covered"""
+        repo_full_name = f"{owner}/{repo}"
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                DELETE FROM agg_commits
+                WHERE repo = %s AND commit_date BETWEEN %s AND %s;
             """, (repo_full_name, since, until))
-            existing_commits = [row[0] for row in cursor.fetchall()]
-        return existing_commits
+            await self.refresh_rollups(cursor, repo_full_name, since, until)
+            await self.conn.commit()
     
-    def store_aggregated_commits(self, owner, repo, aggregated_commits):
-        """Store fetched commits"""
+    async def intern_authors(self, cursor, names) -> Dict[str, int]:
+        """Maps author names to ids of the authors dictionary, inserting unknown names. Known ids come from the process-wide cache,
+        ids read here are only added to it by the caller once its transaction committed, since a rollback can drop the inserted rows"""
+        names = set(names)
+        author_ids = {name: self.AUTHOR_IDS[name] for name in names if name in self.AUTHOR_IDS}
+        missing = sorted(name for name in names if name not in author_ids) #one insert order for all transactions, so they cannot deadlock
+        if missing:
+            await cursor.execute("""
+                INSERT INTO authors (name)
+                SELECT name FROM unnest(%s::text[]) WITH ORDINALITY AS m(name, n)
+                ORDER BY n
+                ON CONFLICT (name) DO NOTHING;
+            """, (missing,))
+            await cursor.execute("SELECT name, id FROM authors WHERE name = ANY(%s);", (missing,))
+            author_ids.update(await cursor.fetchall())
+        return author_ids
+    
+    async def store_aggregated_commits(self, owner, repo, aggregated_commits, covered: Optional[Tuple[date, date]] = None):
+        """Store fetched commits. Counts and authors are added to the stored day, since a streamed day can arrive in several parts.
+        Authors are stored as sorted ids of the authors dictionary. If given, the covered range is recorded as fetched in the same transaction"""
         repo_full_name = f"{owner}/{repo}"
-        with self.conn.cursor() as cursor:
-            for data in aggregated_commits:
-                date = isoparse(data['date']).strftime('%Y-%m-%d')
-                
-                cursor.execute("""
-                    INSERT INTO agg_commits (repo, commit_date, commits, authors)
+        author_ids = {}
+        async with self.conn.cursor() as cursor:
+            if aggregated_commits:
+                author_ids = await self.intern_authors(cursor, [name for data in aggregated_commits for name in data['authors']])
+                rows = [
+                    (repo_full_name, isoparse(data['date']).strftime('%Y-%m-%d'), data['commits'], sorted(author_ids[name] for name in data['authors']))
+                    for data in aggregated_commits
+                ]
+                await cursor.executemany("""
+                    INSERT INTO agg_commits (repo, commit_date, commits, author_ids)
                     VALUES (%s, %s, %s, %s)
                     ON CONFLICT (repo, commit_date)
-                    DO UPDATE SET commits = EXCLUDED.commits, authors = EXCLUDED.authors;
-                """, (repo_full_name, date, data['commits'], data['authors']))
+                    DO UPDATE SET commits = agg_commits.commits + EXCLUDED.commits,
+                                  author_ids = ARRAY(SELECT DISTINCT unnest(agg_commits.author_ids || EXCLUDED.author_ids) ORDER BY 1);
+                """, rows)
+                days = [row[1] for row in rows]
+                await self.refresh_rollups(cursor, repo_full_name, min(days), max(days))
+            if covered and covered[0] <= covered[1]:
+                await self.add_coverage(cursor, repo_full_name, *covered)
 
-            self.conn.commit()
+            await self.conn.commit()
+        self.AUTHOR_IDS.update(author_ids) #only ids whose rows are committed
+    
+    async def refresh_rollups(self, cursor, repo_full_name, since, until):
+        """Recomputes the weekly and monthly rollups of every period touching [since, until] from the daily rows.
+        Each day's commits are summed once (first author ordinal), the authors of all days are counted distinct"""
+        for granularity in ('week', 'month'):
+            params = {'repo': repo_full_name, 'granularity': granularity, 'since': since, 'until': until}
+            await cursor.execute("""
+                DELETE FROM agg_commits_rollups
+                WHERE repo = %(repo)s AND granularity = %(granularity)s
+                  AND period_start BETWEEN date_trunc(%(granularity)s, %(since)s::date)::date AND %(until)s::date;
+            """, params)
+            await cursor.execute("""
+                INSERT INTO agg_commits_rollups (repo, granularity, period_start, commits, authors_count)
+                SELECT repo, %(granularity)s, date_trunc(%(granularity)s, commit_date)::date AS period_start,
+                       sum(commits) FILTER (WHERE u.n = 1), count(DISTINCT u.author)
+                FROM agg_commits, unnest(author_ids) WITH ORDINALITY AS u(author, n)
+                WHERE repo = %(repo)s
+                  AND commit_date >= date_trunc(%(granularity)s, %(since)s::date)::date
+                  AND commit_date < (date_trunc(%(granularity)s, %(until)s::date) + ('1 ' || %(granularity)s)::interval)::date
+                GROUP BY repo, period_start;
+            """, params)
     
-    def get_aggregated_commit_activity(self, owner, repo, since, until) -> List[Tuple[date, int, List[str]]]:
+    async def get_commit_rollups(self, owner, repo, granularity, since, until) -> List[dict]:
+        """Weekly or monthly (commits, distinct authors) of the periods starting in [period of since, until]"""
         repo_full_name = f"{owner}/{repo}"
         
-        with self.conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT commit_date, commits, authors
+        async with self.conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT period_start, commits, authors_count
+                FROM agg_commits_rollups
+                WHERE repo = %(repo)s AND granularity = %(granularity)s
+                  AND period_start BETWEEN date_trunc(%(granularity)s, %(since)s::date)::date AND %(until)s::date
+                ORDER BY period_start;
+            """, {'repo': repo_full_name, 'granularity': granularity, 'since': since, 'until': until})
+            return await cursor.fetchall()
+    
+    async def get_aggregated_commit_activity(self, owner, repo, since, until) -> List[dict]:
+        """RepoActivity rows, columns named after the model fields"""
+        repo_full_name = f"{owner}/{repo}"
+        
+        async with self.conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT c.commit_date AS date, c.commits, ARRAY(SELECT a.name FROM authors a WHERE a.id = ANY(c.author_ids) ORDER BY a.name) AS authors
+                FROM agg_commits c
+                WHERE c.repo = %s AND c.commit_date BETWEEN %s AND %s
+                ORDER BY c.commit_date;
+            """, (repo_full_name, since, until))
+            return await cursor.fetchall()
+    
+    async def get_commit_counts(self, repos: List[str], since, until) -> List[Tuple[str, date, int]]:
+        """Daily commit counts of several repos in one query, days without commits are omitted"""
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT repo, commit_date, commits
                 FROM agg_commits
-                WHERE repo = %s AND commit_date BETWEEN %s AND %s
-                ORDER BY commit_date;
+                WHERE repo = ANY(%s) AND commit_date BETWEEN %s AND %s;
+            """, (repos, since, until))
+            return await cursor.fetchall()
+    
+    async def stream_aggregated_commit_activity(self, owner, repo, since, until) -> AsyncIterator[List[dict]]:
+        """Same rows as get_aggregated_commit_activity, read through a named (server-side) cursor in batches of STREAM_BATCH_SIZE,
+        so memory does not grow with the range. The connection must not be used for anything else until the generator is exhausted or closed"""
+        repo_full_name = f"{owner}/{repo}"
+        
+        try:
+            async with self.conn.cursor(name='activity_stream', row_factory=dict_row) as cursor:
+                await cursor.execute("""
+                    SELECT c.commit_date AS date, c.commits, ARRAY(SELECT a.name FROM authors a WHERE a.id = ANY(c.author_ids) ORDER BY a.name) AS authors
+                    FROM agg_commits c
+                    WHERE c.repo = %s AND c.commit_date BETWEEN %s AND %s
+                    ORDER BY c.commit_date;
+                """, (repo_full_name, since, until))
+                while rows := await cursor.fetchmany(self.STREAM_BATCH_SIZE):
+                    yield rows
+        finally:
+            await self.conn.rollback() #read only, ends the transaction holding the cursor
+    
+    async def count_distinct_authors(self, owner, repo, since, until) -> int:
+        """Unique contributors of [since, until], counted over the integer author ids of the daily rows"""
+        repo_full_name = f"{owner}/{repo}"
+        
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT count(DISTINCT author_id)
+                FROM agg_commits, unnest(author_ids) AS author_id
+                WHERE repo = %s AND commit_date BETWEEN %s AND %s;
             """, (repo_full_name, since, until))
-            return cursor.fetchall()
+            return (await cursor.fetchone())[0]
         
-    def get_repo_creation(self, owner, repo) -> date:
+    async def get_repo_creation(self, owner, repo) -> date:
         repo_full_name = f'{owner}/{repo}'
         
-        with self.conn.cursor() as cursor:
-            cursor.execute("""
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
                 SELECT date_created 
                 FROM repositories
                 WHERE repo = %s;
             """, (repo_full_name,))
                         
-            result = cursor.fetchone()
+            result = await cursor.fetchone()
             return result[0] if result else None
     
-    def get_top100(self) -> List[Tuple[str, int, int, Optional[int], int, int, int, int, Optional[str]]]:
-        with self.conn.cursor() as cursor:
-            cursor.execute("""
+    async def get_repo_creations(self, repos: List[str]) -> Dict[str, date]:
+        """Creation dates of the given repos, repos that are not tracked are left out"""
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT repo, date_created
+                FROM repositories
+                WHERE repo = ANY(%s);
+            """, (repos,))
+            return dict(await cursor.fetchall())
+    
+    async def get_top100(self) -> List[dict]:
+        """Repository rows, columns named after the model fields"""
+        async with self.conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
                 SELECT repo, owner, position_cur, position_prev, stars, watchers, forks, open_issues, language
                 FROM repositories
-                ORDER BY position_cur;
+                WHERE position_cur IS NOT NULL
+                ORDER BY position_cur
+                LIMIT 100;
             """)
-            return cursor.fetchall()
+            return await cursor.fetchall()
     
-    def close(self):
-        self.conn.close()
-        
-        
-        
\ No newline at end of file
+    async def get_repos(self, limit: int, after: int, language: Optional[str]) -> List[dict]:
+        """Keyset page of the ranked repos: the `limit` repos ranked after position `after`, optionally of one language.
+        Served by repositories_position_idx, or repositories_language_position_idx when filtered, without scanning skipped rows"""
+        language_filter = "AND language = %(language)s" if language else ""
+        async with self.conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(f"""
+                SELECT repo, owner, position_cur, position_prev, stars, watchers, forks, open_issues, language
+                FROM repositories
+                WHERE position_cur > %(after)s {language_filter}
+                ORDER BY position_cur
+                LIMIT %(limit)s;
+            """, {'limit': limit, 'after': after, 'language': language})
+            return await cursor.fetchall()
+    
+    async def get_rank_history(self, repos: List[str], since, until, resolution: str) -> List[Tuple[str, datetime, int, int, int]]:
+        """Position snapshots of [since, until] (UTC days), downsampled in SQL to one (bucket, min, max, last) row per
+        hour/day/week, or every snapshot for 'raw'. Served by an index-only scan of repository_history_repo_time_idx"""
+        params = {'repos': repos,
+                  'since': datetime.combine(since, time.min, tzinfo=timezone.utc),
+                  'until': datetime.combine(until + timedelta(days=1), time.min, tzinfo=timezone.utc),
+                  'resolution': resolution}
+        async with self.conn.cursor() as cursor:
+            if resolution == 'raw':
+                await cursor.execute("""
+                    SELECT repo, fetch_date, position, position, position
+                    FROM repository_history
+                    WHERE repo = ANY(%(repos)s) AND fetch_date >= %(since)s AND fetch_date < %(until)s
+                    ORDER BY repo, fetch_date;
+                """, params)
+            else:
+                await cursor.execute("""
+                    SELECT repo, date_trunc(%(resolution)s, fetch_date, 'UTC') AS bucket,
+                           min(position), max(position), (array_agg(position ORDER BY fetch_date DESC))[1]
+                    FROM repository_history
+                    WHERE repo = ANY(%(repos)s) AND fetch_date >= %(since)s AND fetch_date < %(until)s
+                    GROUP BY repo, bucket
+                    ORDER BY repo, bucket;
+                """, params)
+            return await cursor.fetchall()
+    
+    async def get_sync_targets(self) -> List[Tuple[str, date, Optional[date]]]:
+        """Every ranked repo with its sync progress, repos requested most recently first, then by position"""
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT r.repo, r.date_created, s.synced_until
+                FROM repositories r
+                LEFT JOIN sync_state s ON s.repo = r.repo
+                WHERE r.position_cur IS NOT NULL
+                ORDER BY s.last_requested DESC NULLS LAST, r.position_cur;
+            """)
+            return await cursor.fetchall()
+    
+    async def record_requests(self, traffic: Dict[str, int]):
+        """Persists activity request counts collected since the last sync pass"""
+        if not traffic:
+            return
+        async with self.conn.cursor() as cursor:
+            await cursor.executemany("""
+                INSERT INTO sync_state (repo, last_requested, requests)
+                SELECT %s, now(), %s
+                WHERE EXISTS (SELECT 1 FROM repositories WHERE repo = %s)
+                ON CONFLICT (repo)
+                DO UPDATE SET last_requested = EXCLUDED.last_requested,
+                              requests = sync_state.requests + EXCLUDED.requests;
+            """, [(repo, count, repo) for repo, count in traffic.items()])
+            await self.conn.commit()
+    
+    async def is_today_fresh(self, repo_full_name, ttl: float) -> bool:
+        """Whether the current UTC day was fetched less than ttl seconds ago. Today is never in commit_coverage since it can still change"""
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT today_fetched_at >= greatest(date_trunc('day', now(), 'UTC'), now() - make_interval(secs => %s))
+                FROM sync_state
+                WHERE repo = %s;
+            """, (ttl, repo_full_name))
+            result = await cursor.fetchone()
+            return bool(result and result[0])
+    
+    async def set_today_fetched(self, repo_full_name, fetched_at: datetime):
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO sync_state (repo, today_fetched_at)
+                VALUES (%s, %s)
+                ON CONFLICT (repo)
+                DO UPDATE SET today_fetched_at = EXCLUDED.today_fetched_at;
+            """, (repo_full_name, fetched_at))
+            await self.conn.commit()
+    
+    async def set_synced_until(self, repo_full_name, synced_until):
+        async with self.conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO sync_state (repo, synced_until)
+                VALUES (%s, %s)
+                ON CONFLICT (repo)
+                DO UPDATE SET synced_until = EXCLUDED.synced_until;
+            """, (repo_full_name, synced_until))
+            await self.conn.commit()
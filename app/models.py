@@ -1,9 +1,12 @@
 from pydantic import BaseModel
-from typing import List, Optional, Annotated, Tuple
-from fastapi import Query
+import orjson
+from typing import Dict, List, Literal, Optional, Annotated, Tuple
+from fastapi import Query, Request
+from contextlib import asynccontextmanager
 from fastapi.exceptions import HTTPException
-from datetime import date, datetime, timezone
+from datetime import date, datetime, timedelta, timezone
 from app.db import DBInterface
+from app.CommitFetcher import CommitFetcher
 
 
 class Repository(BaseModel):
@@ -16,15 +19,37 @@ class Repository(BaseModel):
     forks: int
     open_issues: int
     language: Optional[str] 
-    
+
 class RepoActivity(BaseModel):
     date: date
     commits: int
     authors: List[str]
     
+class ActivityRollup(BaseModel):
+    period_start: date
+    commits: int
+    authors_count: int
+    
+class ContributorCount(BaseModel):
+    since: date
+    until: date
+    authors_count: int
+    
+class ActivityColumns(BaseModel):
+    dates: List[date]
+    repos: Dict[str, List[int]] #commit counts aligned with dates
+    
+class RankPoint(BaseModel):
+    time: datetime
+    min_position: int
+    max_position: int
+    last_position: int
+    
 
 
 queryParam = Annotated[str, Query(pattern=r'^\d{4}-\d{2}-\d{2}$')]
+resolutionParam = Annotated[Literal['raw', 'hour', 'day', 'week'], Query()]
+granularityParam = Annotated[Literal['day', 'week', 'month'], Query()]
 
 async def query_params(since: queryParam, until: queryParam) -> Tuple[datetime, datetime]:
     if not since or not until:
@@ -43,35 +68,65 @@ async def query_params(since: queryParam, until: queryParam) -> Tuple[datetime,
     return since_date, until_date, current_date
 
 def repos_to_pydantic(queryset) -> List[Repository]:
-    return [
-        Repository(
-            repo = row[0],
-            owner = row[1],
-            position_cur = row[2],
-            position_prev = row[3],
-            stars = row[4],
-            watchers = row[5],
-            forks = row[6],
-            open_issues = row[7],
-            language = row[8]
-        )
-        for row in queryset
-    ]
+    return [Repository(**row) for row in queryset]
 
 def activity_to_pydantic (queryset) -> List[RepoActivity]:
-    return [
-        RepoActivity(
-            date = row[0],
-            commits = row[1],
-            authors = row[2]
+    return [RepoActivity(**row) for row in queryset]
+
+def rollups_to_pydantic (queryset) -> List[ActivityRollup]:
+    return [ActivityRollup(**row) for row in queryset]
+
+#Fast path: DB rows straight to JSON bytes with orjson, skipping per-row model construction and response_model validation.
+#The queries return dict rows whose columns are named after the model fields, so the keys do not depend on the SELECT order
+
+def repos_to_json (queryset) -> bytes:
+    return orjson.dumps(queryset)
+
+def activity_to_json (queryset) -> bytes:
+    return orjson.dumps(queryset)
+
+def rollups_to_json (queryset) -> bytes:
+    return orjson.dumps(queryset)
+
+def activity_to_ndjson (queryset) -> bytes:
+    """One RepoActivity object per line"""
+    return b''.join(orjson.dumps(row) + b'\n' for row in queryset)
+
+def counts_to_json (repos, since, until, queryset) -> bytes:
+    """Columnar ActivityColumns layout"""
+    days = (until - since).days + 1
+    columns = {repo: [0] * days for repo in repos}
+    for row in queryset:
+        columns[row[0]][(row[1] - since).days] = row[2]
+    return orjson.dumps({
+        'dates': [since + timedelta(days=x) for x in range(days)],
+        'repos': columns
+    })
+
+def history_to_pydantic (queryset) -> Dict[str, List[RankPoint]]:
+    history = {}
+    for row in queryset:
+        history.setdefault(row[0], []).append(
+            RankPoint(
+                time = row[1],
+                min_position = row[2],
+                max_position = row[3],
+                last_position = row[4]
+            )
         )
-        for row in queryset
-    ]
+    return history
     
 
-def get_db ():
-    db = DBInterface()
-    try: 
+@asynccontextmanager
+async def pooled_db (request: Request):
+    """Short-lived pooled connection. Handlers that await a shared GitHub fetch use it instead of get_db,
+    so they never hold a connection while the fetch waits for one"""
+    async with request.app.state.pool.connection() as conn:
+        yield DBInterface(conn)
+
+async def get_db (request: Request):
+    async with pooled_db(request) as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+def get_commit_fetcher (request: Request) -> CommitFetcher:
+    return CommitFetcher(request.app.state.http_client)
\ No newline at end of file
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+import httpx
+from psycopg_pool import AsyncConnectionPool
+from app.db import DBInterface
+from app.CommitFetcher import CommitFetcher
+from app.activity import fetch_missing
+
+
+class RateBudget:
+    """Token bucket of GitHub requests shared by every repo the sync worker walks"""
+
+    def __init__(self, per_hour: int) -> None:
+        self.rate = per_hour / 3600
+        self.capacity = max(1, per_hour // 60) #at most a minute worth of requests in a burst
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SyncWorker:
+    """Background task that keeps agg_commits warm for every repo in repositories, so the activity endpoint is served from Postgres.
+    Each pass fetches only the days after a repo's synced_until (or the last LOOKBACK_DAYS for a new repo) and refreshes today,
+    repos with recent request traffic go first. Only one worker process syncs at a time, guarded by an advisory lock."""
+    ENABLED = os.getenv('SYNC_ENABLED', '1') == '1'
+    INTERVAL = float(os.getenv('SYNC_INTERVAL', 900)) #seconds between passes
+    LOOKBACK_DAYS = int(os.getenv('SYNC_LOOKBACK_DAYS', 30))
+    REQUESTS_PER_HOUR = int(os.getenv('SYNC_REQUESTS_PER_HOUR', 1500)) #share of the hourly GitHub quota the worker may use
+    LOCK = 7315002
+
+    def __init__(self, pool: AsyncConnectionPool, client: httpx.AsyncClient) -> None:
+        self.pool = pool
+        self.fetcher = CommitFetcher(client, budget=RateBudget(self.REQUESTS_PER_HOUR))
+        self.traffic = Counter()
+
+    def record_request(self, repo_full_name: str) -> None:
+        """Called by the activity endpoint, flushed to sync_state at the start of every pass of every worker process"""
+        self.traffic[repo_full_name] += 1
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sync_pass()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'Sync pass failed: {e}')
+            await asyncio.sleep(self.INTERVAL)
+
+    async def sync_pass(self) -> None:
+        async with self.pool.connection() as conn:
+            db = DBInterface(conn)
+            #every worker flushes the traffic it served, whichever one holds the lock syncs
+            traffic, self.traffic = self.traffic, Counter()
+            try:
+                await db.record_requests(traffic)
+            except Exception:
+                self.traffic.update(traffic) #kept for the next pass
+                raise
+
+            cursor = await conn.execute("SELECT pg_try_advisory_lock(%s);", (self.LOCK,))
+            locked = (await cursor.fetchone())[0]
+            await conn.commit() #session level lock, outlives the transaction
+            if not locked:
+                return #another worker is syncing
+            try:
+                synced = 0
+                for repo_full_name, date_created, synced_until in await db.get_sync_targets():
+                    if await self.sync_repo(db, repo_full_name, date_created, synced_until):
+                        synced += 1
+                logging.info(f'Sync pass done, {synced} repo(s) updated')
+            finally:
+                await conn.rollback()
+                await conn.execute("SELECT pg_advisory_unlock(%s);", (self.LOCK,))
+                await conn.commit()
+
+    async def sync_repo(self, db: DBInterface, repo_full_name: str, date_created, synced_until: Optional[date]) -> bool:
+        """Fetches [synced_until + 1, today] and persists the new synced_until. Today is fetched again on every pass,
+        so requests find it fresh (see TODAY_TTL) and do not wait for GitHub"""
+        today = datetime.now(tz=timezone.utc).date()
+        yesterday = today - timedelta(days=1)
+        start = synced_until + timedelta(days=1) if synced_until else max(date_created, yesterday - timedelta(days=self.LOOKBACK_DAYS - 1))
+
+        owner, repo = repo_full_name.split('/', 1)
+        try:
+            #never waits for a request fetching the repo, the next pass picks it up
+            await fetch_missing(db, self.fetcher, owner, repo, min(start, today), today, today_ttl=0, lock_wait=0)
+        except (httpx.HTTPError, RuntimeError) as e:
+            logging.error(f'Unable to sync {repo_full_name}: {e}')
+            await db.conn.rollback()
+            return False
+        await db.set_synced_until(repo_full_name, yesterday)
+        return True
+
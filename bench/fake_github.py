@@ -0,0 +1,224 @@
+"""Local stand-in for the parts of the GitHub API the project uses, for offline benchmarks: repository search (REST and GraphQL,
+with the 1000 results cap), repo details and paginated commit listings, with X-RateLimit-* headers and a configurable latency.
+Data is synthetic and deterministic: repo i is owner{i}/repo{i}, stars decrease with i (with ties), commits per day are derived from
+a hash of repo and day. Request counts per endpoint are served at /_stats.
+With --faults, that share of requests is answered with the transient errors GitHub sends (429 with Retry-After,
+502, 503 and the secondary rate limit 403), cycling through them, so retry and backoff paths can be exercised.
+
+    python -m bench.fake_github --port 8765 --latency-ms 50 --repos 5000 --faults 0.1
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+SEARCH_CAP = 1000
+CREATED_AT = '2015-01-01T00:00:00Z'
+LANGUAGES = ['Python', 'JavaScript', 'TypeScript', 'Go', 'Rust', 'C++', None]
+FAULTS = ['429', '502', '503', '403'] #injected in this order
+
+
+def stars_of(i: int) -> int:
+    return 500000 // (i + 1) + 1000 #long tail, equal star counts further down exercise the search window ties
+
+
+def parse_stars(q: str) -> Tuple[int, Optional[int]]:
+    """Bounds of a stars:low..high qualifier, high is None for *"""
+    match = re.search(r'stars:(\d+)\.\.(\d+|\*)', q)
+    if not match:
+        return 0, None
+    return int(match.group(1)), None if match.group(2) == '*' else int(match.group(2))
+
+
+def daily_commits(repo: str, day: date, per_day: int) -> int:
+    return int(hashlib.md5(f'{repo}{day}'.encode()).hexdigest()[:8], 16) % (2 * per_day + 1)
+
+
+def fault_response(kind: str, retry_after: float, headers: dict) -> JSONResponse:
+    if kind == '429':
+        return JSONResponse({'message': 'API rate limit exceeded'}, status_code=429, headers={**headers, 'Retry-After': f'{retry_after:g}'})
+    if kind == '403':
+        return JSONResponse({'message': 'You have exceeded a secondary rate limit. Please wait a few minutes before you try again.'}, status_code=403, headers=headers)
+    return JSONResponse({'message': 'Server Error'}, status_code=int(kind), headers=headers)
+
+
+def create_app(repos: int = 5000, latency_ms: float = 0, commits_per_day: int = 10, rate_limit: int = 1000000,
+               faults: float = 0, retry_after: float = 1) -> FastAPI:
+    app = FastAPI()
+    app.state.calls = Counter()
+    app.state.faults = Counter()
+    app.state.remaining = rate_limit
+    app.state.seen = 0
+    names = [f'owner{i}/repo{i}' for i in range(repos)]
+    index = {name: i for i, name in enumerate(names)}
+
+    def search(q: str) -> List[int]:
+        """Indexes of the repos matching q, most starred first, capped like GitHub search"""
+        low, high = parse_stars(q)
+        return [i for i in range(repos) if stars_of(i) >= low and (high is None or stars_of(i) <= high)][:SEARCH_CAP]
+
+    def repo_json(i: int) -> dict:
+        owner = names[i].split('/')[0]
+        return {
+            'name': names[i].split('/')[1],
+            'full_name': names[i],
+            'owner': {'login': owner},
+            'stargazers_count': stars_of(i),
+            'watchers_count': stars_of(i),
+            'subscribers_count': stars_of(i) // 50,
+            'forks_count': stars_of(i) // 8,
+            'open_issues': i % 700,
+            'language': LANGUAGES[i % len(LANGUAGES)],
+            'created_at': CREATED_AT
+        }
+
+    @app.middleware('http')
+    async def github_behaviour(request: Request, call_next):
+        if request.url.path.startswith('/_'):
+            return await call_next(request)
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        app.state.remaining = max(0, app.state.remaining - 1)
+        headers = {'X-RateLimit-Limit': str(rate_limit),
+                   'X-RateLimit-Remaining': str(app.state.remaining),
+                   'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+        if app.state.remaining == 0:
+            return JSONResponse({'message': 'API rate limit exceeded'}, status_code=403, headers=headers)
+        app.state.seen += 1
+        if faults and app.state.seen % round(1 / faults) == 0: #every n-th request, so a retry of it is not faulted again
+            kind = FAULTS[sum(app.state.faults.values()) % len(FAULTS)]
+            app.state.faults[kind] += 1
+            return fault_response(kind, retry_after, headers)
+        response = await call_next(request)
+        response.headers.update(headers)
+        return response
+
+    @app.get('/_stats')
+    async def stats():
+        return {'calls': dict(app.state.calls), 'total': sum(app.state.calls.values()), 'faults': dict(app.state.faults), 'remaining': app.state.remaining}
+
+    @app.post('/_reset')
+    async def reset():
+        app.state.calls.clear()
+        app.state.faults.clear()
+        app.state.remaining = rate_limit
+        app.state.seen = 0
+        return {}
+
+    @app.get('/search/repositories')
+    async def search_repositories(q: str, per_page: int = 30, page: int = 1):
+        app.state.calls['search'] += 1
+        found = search(q)
+        items = found[(page - 1) * per_page:page * per_page]
+        return {'total_count': len(found), 'incomplete_results': False, 'items': [repo_json(i) for i in items]}
+
+    @app.get('/repos/{owner}/{repo}')
+    async def repo_details(owner: str, repo: str):
+        app.state.calls['repo'] += 1
+        i = index.get(f'{owner}/{repo}')
+        if i is None:
+            return JSONResponse({'message': 'Not Found'}, status_code=404)
+        return repo_json(i)
+
+    @app.get('/repos/{owner}/{repo}/commits')
+    async def commits(request: Request, owner: str, repo: str, since: str, until: str, per_page: int = 30, page: int = 1):
+        """Commits of [since, until] newest first, paged with Link headers like GitHub"""
+        app.state.calls['commits'] += 1
+        full_name = f'{owner}/{repo}'
+        first, last = date.fromisoformat(since[:10]), date.fromisoformat(until[:10])
+        listed, start, end, total = [], (page - 1) * per_page, page * per_page, 0
+        day = last
+        while day >= first:
+            count = daily_commits(full_name, day, commits_per_day)
+            for n in range(max(0, start - total), min(count, end - total)): #only the requested page is materialized
+                listed.append({'sha': f'{full_name}{day}{n}',
+                               'commit': {'author': {'name': f'author {n % 7}', 'date': f'{day}T12:00:00Z'},
+                                          'committer': {'name': f'author {n % 7}', 'date': f'{day}T12:00:00Z'}}})
+            total += count
+            day -= timedelta(days=1)
+
+        headers = {}
+        if end < total:
+            headers['Link'] = f'<{request.url.include_query_params(page=page + 1)}>; rel="next"'
+        return JSONResponse(listed, headers=headers)
+
+    @app.post('/graphql')
+    async def graphql(request: Request):
+        app.state.calls['graphql'] += 1
+        variables = (await request.json())['variables']
+        found = search(variables['q'])
+        offset = int(variables.get('after') or 0)
+        page = found[offset:offset + variables['first']]
+        nodes = [{
+            'nameWithOwner': names[i],
+            'owner': {'login': names[i].split('/')[0]},
+            'stargazerCount': stars_of(i),
+            'watchers': {'totalCount': stars_of(i) // 50},
+            'forkCount': stars_of(i) // 8,
+            'issues': {'totalCount': i % 500},
+            'pullRequests': {'totalCount': i % 200},
+            'primaryLanguage': {'name': LANGUAGES[i % len(LANGUAGES)]} if LANGUAGES[i % len(LANGUAGES)] else None,
+            'createdAt': CREATED_AT
+        } for i in page]
+        end = offset + len(page)
+        return {'data': {'search': {'pageInfo': {'hasNextPage': end < len(found), 'endCursor': str(end)}, 'nodes': nodes}}}
+
+    return app
+
+
+class FakeGitHubProcess:
+    """Runs the fake server in a subprocess for the duration of a with block, so its CPU and memory stay out of the measured process"""
+
+    def __init__(self, port: int, **options) -> None:
+        self.url = f'http://127.0.0.1:{port}'
+        self.args = [sys.executable, '-m', 'bench.fake_github', '--port', str(port)]
+        for name, value in options.items():
+            self.args += [f"--{name.replace('_', '-')}", str(value)]
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.args, env=os.environ.copy())
+        for _ in range(300):
+            try:
+                httpx.get(f'{self.url}/_stats')
+                return self
+            except httpx.TransportError:
+                time.sleep(0.1)
+        self.process.terminate()
+        raise RuntimeError('Fake GitHub did not start')
+
+    def __exit__(self, *exc) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+    def stats(self, reset: bool = False) -> dict:
+        if reset:
+            httpx.post(f'{self.url}/_reset')
+        return httpx.get(f'{self.url}/_stats').json()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--repos', type=int, default=5000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--commits-per-day', type=int, default=10)
+    parser.add_argument('--rate-limit', type=int, default=1000000)
+    parser.add_argument('--faults', type=float, default=0, help='share of requests answered with a transient error')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of injected 429s, seconds')
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.repos, args.latency_ms, args.commits_per_day, args.rate_limit, args.faults, args.retry_after),
+                host='127.0.0.1', port=args.port, log_level='warning')
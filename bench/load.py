@@ -0,0 +1,66 @@
+"""Load benchmark for the API. Fires a fixed number of requests at an endpoint for each concurrency level
+and prints one JSON line per level, so throughput scaling with concurrency is easy to compare between builds.
+
+    python -m bench.load --url http://localhost:8000 --path /api/repos/top100 --concurrency 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from statistics import quantiles
+from typing import List
+
+import httpx
+
+
+async def worker(client: httpx.AsyncClient, path: str, remaining: List[int], latencies: List[float], errors: List[int]) -> None:
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        start = time.perf_counter()
+        try:
+            rsp = await client.get(path)
+            if rsp.status_code >= 400:
+                errors[0] += 1
+        except httpx.HTTPError:
+            errors[0] += 1
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_level(url: str, path: str, concurrency: int, requests: int) -> dict:
+    """Runs `requests` requests with `concurrency` workers sharing one connection pool"""
+    latencies, errors, remaining = [], [0], [requests]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, path, remaining, latencies, errors) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    cuts = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'path': path,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(cuts[49] * 1000, 2),
+        'p95_ms': round(cuts[94] * 1000, 2),
+        'p99_ms': round(cuts[98] * 1000, 2)
+    }
+
+
+async def main(args) -> None:
+    for concurrency in args.concurrency:
+        result = await run_level(args.url, args.path, concurrency, args.requests)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--path', default='/api/repos/top100')
+    parser.add_argument('--requests', type=int, default=500, help='requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,79 @@
+"""Check of the RequestScheduler retry paths against bench.fake_github with injected faults (429 with Retry-After,
+502, 503, secondary rate limit 403). Drives the sync and async request paths, fails unless every request ends in a 200
+after retrying each kind of fault, and prints one JSON line per path with requests, attempts, faults and wall time.
+
+    python -m bench.retry --requests 200 --faults 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+import httpx
+import requests
+
+from bench.fake_github import FAULTS, FakeGitHubProcess
+from common.http_cache import HTTPCache
+from common.scheduler import RequestScheduler
+
+
+def scheduler() -> RequestScheduler:
+    """Fresh scheduler with a cold cache, backoff shortened so the check runs in seconds. Concurrent retries can land on
+    another injected fault, the retry budget is raised so only a broken retry path fails the check"""
+    sched = RequestScheduler(tokens=['bench'], cache=HTTPCache(cache_dir=tempfile.mkdtemp(prefix='bench_http_cache_')))
+    sched.BACKOFF_BASE = 0.01
+    sched.BACKOFF_MAX = 0.05
+    sched.MAX_RETRIES = 10
+    return sched
+
+
+def check(path: str, github: FakeGitHubProcess, statuses: list, attempts: int, seconds: float) -> dict:
+    stats = github.stats()
+    failed = [status for status in statuses if status != 200]
+    if failed:
+        raise AssertionError(f'{path}: {len(failed)} request(s) did not recover, final statuses {sorted(set(failed))}')
+    missing = [kind for kind in FAULTS if not stats['faults'].get(kind)]
+    if missing:
+        raise AssertionError(f'{path}: faults {missing} were never injected, raise --requests or --faults')
+    return {
+        'path': path,
+        'requests': len(statuses),
+        'attempts': attempts,
+        'faults': stats['faults'],
+        'seconds': round(seconds, 3)
+    }
+
+
+def run_sync(github: FakeGitHubProcess, args) -> dict:
+    github.stats(reset=True)
+    sched = scheduler()
+    start = time.perf_counter()
+    statuses = [sched.request(requests, 'GET', f'{github.url}/repos/owner{i % 100}/repo{i % 100}').status_code for i in range(args.requests)]
+    return check('sync', github, statuses, sched.requests, time.perf_counter() - start)
+
+
+async def run_async(github: FakeGitHubProcess, args) -> dict:
+    github.stats(reset=True)
+    sched = scheduler()
+    start = time.perf_counter()
+    async with httpx.AsyncClient() as client:
+        responses = await asyncio.gather(*(
+            sched.arequest(client, 'GET', f'{github.url}/repos/owner{i % 100}/repo{i % 100}') for i in range(args.requests)
+        ))
+    return check('async', github, [rsp.status_code for rsp in responses], sched.requests, time.perf_counter() - start)
+
+
+def main(args) -> None:
+    with FakeGitHubProcess(args.port, faults=args.faults, retry_after=0) as github:
+        print(json.dumps(run_sync(github, args)), flush=True)
+        print(json.dumps(asyncio.run(run_async(github, args))), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--faults', type=float, default=0.25, help='share of requests answered with a transient error')
+    parser.add_argument('--port', type=int, default=8765)
+    main(parser.parse_args())
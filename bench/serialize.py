@@ -0,0 +1,86 @@
+"""Micro-benchmark of response serialization. For each response shape it compares the pydantic path
+(rows -> models -> response_model validation -> JSON, as FastAPI does it) with the orjson fast path in app.models,
+after checking that the fast path output conforms to the response model. Prints one JSON line per shape.
+
+    python -m bench.serialize --rows 100 3650 36500
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import date, timedelta
+from typing import Callable, List
+
+from pydantic import TypeAdapter
+
+import app.models as models
+
+
+def repo_rows(n: int) -> list:
+    return [
+        {'repo': f'repo{i}', 'owner': f'owner{i}', 'position_cur': i + 1, 'position_prev': random.choice([None, i + 2]),
+         'stars': random.randint(50000, 400000), 'watchers': random.randint(1000, 10000), 'forks': random.randint(1000, 90000),
+         'open_issues': random.randint(0, 5000), 'language': random.choice([None, 'Python', 'C++'])}
+        for i in range(n)
+    ]
+
+
+def activity_rows(n: int) -> list:
+    start = date(2000, 1, 1)
+    return [{'date': start + timedelta(days=i), 'commits': random.randint(1, 200), 'authors': [f'author {j}' for j in range(random.randint(1, 20))]} for i in range(n)]
+
+
+def rollup_rows(n: int) -> list:
+    start = date(2000, 1, 3)
+    return [{'period_start': start + timedelta(weeks=i), 'commits': random.randint(1, 2000), 'authors_count': random.randint(1, 100)} for i in range(n)]
+
+
+def pydantic_path(adapter: TypeAdapter, to_pydantic: Callable) -> Callable[[list], bytes]:
+    """What FastAPI does with a response_model: validate the returned models, dump them in json mode, encode with json"""
+    def serialize(rows: list) -> bytes:
+        value = adapter.validate_python(to_pydantic(rows), from_attributes=True)
+        return json.dumps(adapter.dump_python(value, mode='json'), ensure_ascii=False, separators=(',', ':')).encode()
+    return serialize
+
+
+def check_conformance(adapter: TypeAdapter, expected: bytes, body: bytes, name: str) -> None:
+    """The fast path body must parse into the response model and carry exactly the fields of the pydantic output"""
+    adapter.validate_json(body)
+    if json.loads(body) != json.loads(expected):
+        raise AssertionError(f'{name}: orjson output differs from the response model output')
+
+
+def timed(fn: Callable[[list], bytes], rows: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(rows)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(args) -> None:
+    shapes = [
+        ('top100', TypeAdapter(List[models.Repository]), repo_rows, models.repos_to_pydantic, models.repos_to_json),
+        ('activity', TypeAdapter(List[models.RepoActivity]), activity_rows, models.activity_to_pydantic, models.activity_to_json),
+        ('rollups', TypeAdapter(List[models.ActivityRollup]), rollup_rows, models.rollups_to_pydantic, models.rollups_to_json),
+    ]
+    for n in args.rows:
+        for name, adapter, make_rows, to_pydantic, to_json in shapes:
+            rows = make_rows(n)
+            slow = pydantic_path(adapter, to_pydantic)
+            check_conformance(adapter, slow(rows), to_json(rows), name)
+            slow_s, fast_s = timed(slow, rows, args.repeat), timed(to_json, rows, args.repeat)
+            print(json.dumps({
+                'shape': name,
+                'rows': n,
+                'pydantic_ms': round(slow_s * 1000, 3),
+                'orjson_ms': round(fast_s * 1000, 3),
+                'speedup': round(slow_s / fast_s, 1)
+            }), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 3650, 36500])
+    parser.add_argument('--repeat', type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,165 @@
+"""Offline benchmark suite. Runs the hot paths against bench.fake_github and a local Postgres (CONN_DETAILS, use a scratch database,
+the parser writes to it) and prints one JSON line per result with wall time, GitHub API calls, latency percentiles and peak RSS:
+
+    parser   Top100Getter.run: search windows, repo details, journal and snapshot commit
+    commits  CommitFetcher.stream_commits over --days days for --commit-repos repos
+    api      the FastAPI app in a uvicorn subprocess, every endpoint driven by bench.load at each concurrency level
+
+The fake GitHub runs in its own subprocess, so its CPU and memory stay out of the measurements. Peak RSS of parser and commits
+is the suite process peak so far (ru_maxrss only grows), the api peak is the server subprocess, reported in a last line once it exited. Run from the repository root, the api scenario expects the parser scenario to have filled the database.
+
+    CONN_DETAILS="dbname=bench" python -m bench.suite --top-n 1000 --latency-ms 20 --concurrency 1 16 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from bench.fake_github import FakeGitHubProcess
+from bench.load import run_level
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1) #KiB on Linux
+
+
+def bench_parser(args, github: FakeGitHubProcess) -> dict:
+    from parser.parser import Top100Getter
+    from parser.db import mainDB
+
+    github.stats(reset=True)
+    start = time.perf_counter()
+    db = mainDB()
+    try:
+        committed = Top100Getter().run(db)
+    finally:
+        db.close()
+    return {
+        'scenario': 'parser',
+        'mode': Top100Getter.MODE,
+        'top_n': args.top_n,
+        'committed': committed,
+        'seconds': round(time.perf_counter() - start, 3),
+        'github_calls': github.stats()['calls'],
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+async def bench_commits(args, github: FakeGitHubProcess) -> dict:
+    from app.CommitFetcher import CommitFetcher
+
+    github.stats(reset=True)
+    until = datetime.now(tz=timezone.utc).date() - timedelta(days=1)
+    since = until - timedelta(days=args.days - 1)
+    commits = 0
+    start = time.perf_counter()
+    async with CommitFetcher.create_client() as client:
+        fetcher = CommitFetcher(client)
+        for i in range(args.commit_repos):
+            async for days, _ in fetcher.stream_commits(f'owner{i}', f'repo{i}', since, until):
+                commits += sum(day['commits'] for day in days)
+    return {
+        'scenario': 'commits',
+        'repos': args.commit_repos,
+        'days': args.days,
+        'commits': commits,
+        'seconds': round(time.perf_counter() - start, 3),
+        'github_calls': github.stats()['calls'],
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def api_paths(args) -> list:
+    until = datetime.now(tz=timezone.utc).date()
+    since = until - timedelta(days=args.days - 1)
+    dates = f'since={since}&until={until}'
+    batch = '&'.join(f'repos=owner{i}/repo{i}' for i in range(min(args.top_n, 100)))
+    return [
+        '/api/repos/top100',
+        '/api/repos?limit=100&after=100',
+        '/api/repos?limit=100&language=Python',
+        f'/api/repos/owner0/repo0/activity?{dates}',
+        f'/api/repos/owner0/repo0/activity?{dates}&granularity=week',
+        f'/api/repos/owner0/repo0/activity/stream?{dates}',
+        f'/api/repos/owner0/repo0/contributors?{dates}',
+        f'/api/repos/activity?{batch}&{dates}',
+        f'/api/repos/owner0/repo0/history?{dates}&resolution=hour'
+    ]
+
+
+async def bench_api(args, github: FakeGitHubProcess) -> None:
+    """Starts the API as a separate process so its RSS and CPU are not mixed with the load generator"""
+    api_url = f'http://127.0.0.1:{args.api_port}'
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.api:app', '--host', '127.0.0.1', '--port', str(args.api_port), '--log-level', 'warning'],
+                              env=os.environ.copy())
+    try:
+        async with httpx.AsyncClient(base_url=api_url) as client:
+            for _ in range(600):
+                try:
+                    if (await client.get('/')).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError('API did not start')
+
+        for path in api_paths(args):
+            for concurrency in args.concurrency:
+                github.stats(reset=True) #only the first level of an endpoint should reach GitHub
+                result = await run_level(api_url, path, concurrency, args.requests)
+                print(json.dumps(dict(result, scenario='api', github_calls=github.stats()['calls'])), flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps({'scenario': 'api', 'peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}), flush=True)
+
+
+def main(args) -> None:
+    if not os.getenv('CONN_DETAILS'):
+        raise SystemExit('CONN_DETAILS must point at a local scratch Postgres database')
+    github_url = f'http://127.0.0.1:{args.github_port}'
+    #read by class attributes at import time, so set before the project modules are imported
+    os.environ.update({
+        'GITHUB_API_URL': github_url,
+        'GITHUB_GRAPHQL_URL': f'{github_url}/graphql',
+        'GITHUB_TOKENS': 'bench',
+        'HTTP_CACHE_DIR': tempfile.mkdtemp(prefix='bench_http_cache_'), #cold cache on every run
+        'TOP_N': str(args.top_n),
+        'PARSER_MODE': args.mode,
+        'SYNC_ENABLED': '0'
+    })
+
+    with FakeGitHubProcess(args.github_port, repos=args.repos, latency_ms=args.latency_ms, commits_per_day=args.commits_per_day) as github:
+        if 'parser' in args.scenarios:
+            print(json.dumps(bench_parser(args, github)), flush=True)
+        if 'commits' in args.scenarios:
+            print(json.dumps(asyncio.run(bench_commits(args, github))), flush=True)
+        if 'api' in args.scenarios:
+            asyncio.run(bench_api(args, github))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=['parser', 'commits', 'api'], default=['parser', 'commits', 'api'])
+    parser.add_argument('--mode', choices=['rest', 'graphql'], default='rest', help='parser mode')
+    parser.add_argument('--top-n', type=int, default=100)
+    parser.add_argument('--repos', type=int, default=5000, help='repos known to the fake GitHub')
+    parser.add_argument('--latency-ms', type=float, default=20, help='fake GitHub latency per request')
+    parser.add_argument('--commits-per-day', type=int, default=10, help='mean commits per repo and day')
+    parser.add_argument('--days', type=int, default=90, help='activity range of the commits and api scenarios')
+    parser.add_argument('--commit-repos', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--github-port', type=int, default=8765)
+    parser.add_argument('--api-port', type=int, default=8766)
+    main(parser.parse_args())
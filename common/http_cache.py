@@ -0,0 +1,176 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+import httpx
+
+
+class HTTPCache:
+    """On-disk cache of GitHub GET responses, shared by the parser and CommitFetcher.
+    Every stored URL keeps its ETag/Last-Modified and body. Subsequent requests are sent as conditional requests,
+    a 304 (which GitHub does not charge against the rate limit) is replayed as a 200 with the stored body.
+    The cache directory is bounded by MAX_BYTES, least recently used entries are evicted first."""
+
+    CACHE_DIR = os.getenv('HTTP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'github_http_cache'))
+    MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    STORED_HEADERS = ('etag', 'last-modified', 'link', 'content-type')
+    DROPPED_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding')
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None) -> None:
+        self.cache_dir = cache_dir or self.CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else self.MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def load(self, url: str) -> Optional[dict]:
+        try:
+            with open(self.path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def conditional_headers(self, entry: Optional[dict]) -> dict:
+        if not entry:
+            return {}
+        headers = {}
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def replay_headers(self, entry: dict, headers) -> dict:
+        """Stored headers overlaid with the fresh ones from the 304 (rate limit headers etc.)"""
+        replayed = dict(entry['headers'])
+        replayed.update({name.lower(): value for name, value in headers.items() if name.lower() not in self.DROPPED_HEADERS})
+        return replayed
+
+    def store(self, url: str, headers, body: bytes) -> None:
+        """Writes an entry atomically, then evicts old entries if the cache grew over max_bytes"""
+        stored_headers = {name: headers[name] for name in self.STORED_HEADERS if name in headers}
+        if 'etag' not in stored_headers and 'last-modified' not in stored_headers:
+            return
+        data = json.dumps({'url': url, 'headers': stored_headers, 'body': body.decode()}).encode()
+        path = self.path(url)
+
+        with self.lock:
+            try:
+                previous = os.path.getsize(path)
+            except OSError:
+                previous = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.size += len(data) - previous
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """Drops least recently used entries until the cache is at 90% of max_bytes. Hits bump mtime, so mtime order is LRU order"""
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json')),
+                         key=lambda entry: entry.stat().st_mtime)
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self.size <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                continue
+        logging.info(f'HTTP cache evicted entries, size is now {self.size} bytes')
+
+    def touch(self, url: str) -> None:
+        try:
+            os.utime(self.path(url))
+        except OSError:
+            pass
+
+    def get(self, session, url: str, params: Optional[dict] = None, headers: Optional[dict] = None, **kwargs) -> requests.Response:
+        """Conditional GET through requests (or a requests.Session). Returns a regular requests.Response"""
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        entry = self.load(full_url)
+
+        rsp = session.get(full_url, headers={**(headers or {}), **self.conditional_headers(entry)}, **kwargs)
+
+        if rsp.status_code == 304 and entry:
+            self.hit(full_url)
+            replayed = requests.Response()
+            replayed.status_code = 200
+            replayed.url = rsp.url
+            replayed.request = rsp.request
+            replayed.headers = CaseInsensitiveDict(self.replay_headers(entry, rsp.headers))
+            replayed._content = entry['body'].encode()
+            replayed.encoding = 'utf-8'
+            return replayed
+
+        self.miss()
+        if rsp.status_code == 200:
+            self.store(full_url, rsp.headers, rsp.content)
+        return rsp
+
+    async def aget(self, client: httpx.AsyncClient, url: str, params: Optional[dict] = None, headers: Optional[dict] = None, **kwargs) -> httpx.Response:
+        """Conditional GET through an httpx.AsyncClient. Returns a regular httpx.Response.
+        Disk work (reading, writing and evicting entries) runs in worker threads, so the event loop is never blocked on it"""
+        request = client.build_request('GET', url, params=params)
+        full_url = str(request.url)
+        entry = await asyncio.to_thread(self.load, full_url)
+
+        rsp = await client.get(full_url, headers={**(headers or {}), **self.conditional_headers(entry)}, **kwargs)
+
+        if rsp.status_code == 304 and entry:
+            await asyncio.to_thread(self.hit, full_url)
+            return httpx.Response(200,
+                                  headers=self.replay_headers(entry, rsp.headers),
+                                  content=entry['body'].encode(),
+                                  request=rsp.request)
+
+        self.miss()
+        if rsp.status_code == 200:
+            await asyncio.to_thread(self.store, full_url, rsp.headers, rsp.content)
+        return rsp
+
+    def hit(self, url: str) -> None:
+        with self.lock:
+            self.hits += 1
+        self.touch(url)
+
+    def miss(self) -> None:
+        with self.lock:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            'bytes': self.size
+        }
+
+
+_cache = None
+
+def get_cache() -> HTTPCache:
+    """Process-wide cache instance, created on first use"""
+    global _cache
+    if _cache is None:
+        _cache = HTTPCache()
+    return _cache
@@ -0,0 +1,211 @@
+"""Versioned schema migrations shared by the API and the parser. Each migration runs exactly once per database,
+applied versions are recorded in schema_migrations. Run at deploy with `python -m common.migrations`,
+the API and the parser also apply pending migrations once on startup."""
+
+import psycopg
+import logging
+import os
+from datetime import date
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def create_history_partition(cursor, month: date) -> None:
+    """Creates the monthly (UTC) partition of repository_history holding `month`, unless it exists"""
+    month = month.replace(day=1)
+    name = f"repository_history_y{month.year}m{month.month:02d}"
+    cursor.execute("SELECT to_regclass(%s);", (name,))
+    if cursor.fetchone()[0] is not None:
+        return
+    cursor.execute(f"""
+        CREATE TABLE {name} PARTITION OF repository_history
+        FOR VALUES FROM ('{month} 00:00:00+00') TO ('{next_month(month)} 00:00:00+00');
+    """)
+
+
+def partition_repository_history(cursor) -> None:
+    """Rebuilds repository_history as a table range-partitioned by month on fetch_date, with a BRIN index on fetch_date.
+    Existing rows are copied into their monthly partitions"""
+    cursor.execute("ALTER TABLE repository_history RENAME TO repository_history_legacy;")
+    cursor.execute("ALTER INDEX repository_history_pkey RENAME TO repository_history_legacy_pkey;")
+    cursor.execute("""
+        CREATE TABLE repository_history (
+            repo TEXT NOT NULL,
+            position INT NOT NULL,
+            fetch_date TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (repo, fetch_date),
+            FOREIGN KEY (repo) REFERENCES repositories(repo)
+        ) PARTITION BY RANGE (fetch_date);
+    """)
+    cursor.execute("""
+        SELECT date_trunc('month', min(fetch_date) AT TIME ZONE 'UTC')::date, date_trunc('month', now() AT TIME ZONE 'UTC')::date
+        FROM repository_history_legacy;
+    """)
+    first, current = cursor.fetchone()
+    month = first or current
+    while month <= next_month(current):
+        create_history_partition(cursor, month)
+        month = next_month(month)
+    cursor.execute("""
+        INSERT INTO repository_history (repo, position, fetch_date)
+        SELECT repo, position, fetch_date FROM repository_history_legacy;
+    """)
+    cursor.execute("DROP TABLE repository_history_legacy;")
+    cursor.execute("CREATE INDEX repository_history_fetch_date_brin ON repository_history USING brin (fetch_date);")
+
+
+MIGRATIONS = [
+    (1, 'create repositories', """
+        CREATE TABLE IF NOT EXISTS repositories (
+            repo TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            position_cur INT NOT NULL,
+            position_prev INT,
+            stars INT NOT NULL,
+            watchers INT NOT NULL,
+            forks INT NOT NULL,
+            open_issues INT NOT NULL,
+            language TEXT,
+            date_created DATE NOT NULL
+        );
+    """),
+    (2, 'create repository_history', """
+        CREATE TABLE IF NOT EXISTS repository_history (
+            repo TEXT NOT NULL,
+            position INT NOT NULL,
+            fetch_date TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (repo, fetch_date),
+            FOREIGN KEY (repo) REFERENCES repositories(repo)
+        );
+    """),
+    (3, 'create agg_commits', """
+        CREATE TABLE IF NOT EXISTS agg_commits (
+            repo TEXT NOT NULL,
+            commit_date DATE NOT NULL,
+            commits INT NOT NULL,
+            authors TEXT[] NOT NULL,
+            PRIMARY KEY (repo, commit_date),
+            FOREIGN KEY (repo) REFERENCES repositories(repo) ON DELETE CASCADE
+        );
+    """),
+    (4, 'create commit_coverage', """
+        CREATE TABLE IF NOT EXISTS commit_coverage (
+            repo TEXT NOT NULL,
+            covered DATERANGE NOT NULL,
+            FOREIGN KEY (repo) REFERENCES repositories(repo) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS commit_coverage_repo_idx ON commit_coverage (repo);
+    """),
+    (5, 'create sync_state', """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            repo TEXT PRIMARY KEY,
+            synced_until DATE,
+            last_requested TIMESTAMPTZ,
+            requests BIGINT NOT NULL DEFAULT 0,
+            FOREIGN KEY (repo) REFERENCES repositories(repo) ON DELETE CASCADE
+        );
+    """),
+    (6, 'partition repository_history by month', partition_repository_history),
+    (7, 'covering index for rank history buckets', """
+        CREATE INDEX IF NOT EXISTS repository_history_repo_time_idx ON repository_history (repo, fetch_date) INCLUDE (position);
+    """),
+    (8, 'create agg_commits_rollups', """
+        CREATE TABLE IF NOT EXISTS agg_commits_rollups (
+            repo TEXT NOT NULL,
+            granularity TEXT NOT NULL CHECK (granularity IN ('week', 'month')),
+            period_start DATE NOT NULL,
+            commits INT NOT NULL,
+            authors_count INT NOT NULL,
+            PRIMARY KEY (repo, granularity, period_start),
+            FOREIGN KEY (repo) REFERENCES repositories(repo) ON DELETE CASCADE
+        );
+        INSERT INTO agg_commits_rollups (repo, granularity, period_start, commits, authors_count)
+        SELECT repo, g.granularity, date_trunc(g.granularity, commit_date)::date AS period_start,
+               sum(commits) FILTER (WHERE u.n = 1), count(DISTINCT u.author)
+        FROM agg_commits, unnest(authors) WITH ORDINALITY AS u(author, n), (VALUES ('week'), ('month')) AS g(granularity)
+        GROUP BY repo, g.granularity, period_start;
+    """),
+    (9, 'normalize agg_commits authors into an authors dictionary', """
+        CREATE TABLE IF NOT EXISTS authors (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        INSERT INTO authors (name)
+        SELECT DISTINCT unnest(authors) FROM agg_commits
+        ON CONFLICT (name) DO NOTHING;
+        ALTER TABLE agg_commits ADD COLUMN author_ids INT[] NOT NULL DEFAULT '{}';
+        UPDATE agg_commits c
+        SET author_ids = ARRAY(SELECT a.id FROM authors a WHERE a.name = ANY(c.authors) ORDER BY a.id);
+        ALTER TABLE agg_commits DROP COLUMN authors;
+        ALTER TABLE agg_commits ALTER COLUMN author_ids DROP DEFAULT;
+    """),
+    (10, 'keyset pagination indexes for the top N', """
+        ALTER TABLE repositories ALTER COLUMN position_cur DROP NOT NULL;
+        CREATE INDEX IF NOT EXISTS repositories_position_idx ON repositories (position_cur) WHERE position_cur IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS repositories_language_position_idx ON repositories (language, position_cur) WHERE position_cur IS NOT NULL;
+    """),
+    (11, 'create parser run journal', """
+        CREATE TABLE IF NOT EXISTS parser_runs (
+            id BIGSERIAL PRIMARY KEY,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ,
+            repos JSONB NOT NULL,
+            fetched INT
+        );
+        CREATE TABLE IF NOT EXISTS parser_run_items (
+            run_id BIGINT NOT NULL,
+            position INT NOT NULL,
+            payload JSONB NOT NULL,
+            PRIMARY KEY (run_id, position),
+            FOREIGN KEY (run_id) REFERENCES parser_runs(id) ON DELETE CASCADE
+        );
+    """),
+    (12, 'track when the current day was last fetched', """
+        ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS today_fetched_at TIMESTAMPTZ;
+    """),
+]
+
+MIGRATIONS_LOCK = 7315001 #advisory lock key, serializes concurrent startups of several workers
+
+
+def migrate(conn: psycopg.Connection) -> int:
+    """Applies pending migrations in one transaction. A migration is either an SQL string or a callable taking a cursor.
+    Returns the number of applied migrations"""
+    applied = 0
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK,))
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            """)
+            cursor.execute("SELECT version FROM schema_migrations;")
+            done = {row[0] for row in cursor.fetchall()}
+
+            for version, description, migration in MIGRATIONS:
+                if version in done:
+                    continue
+                logging.info(f'Applying migration {version}: {description}')
+                if callable(migration):
+                    migration(cursor)
+                else:
+                    cursor.execute(migration)
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);", (version, description))
+                applied += 1
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise RuntimeError(f"Error applying migrations: {e}")
+    return applied
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    with psycopg.connect(os.getenv('CONN_DETAILS')) as conn:
+        logging.info(f'Applied {migrate(conn)} migration(s)')
@@ -0,0 +1,156 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import requests
+import httpx
+
+from common.http_cache import HTTPCache, get_cache
+
+
+class TokenState:
+    """Rate limit budget of one token, as last reported by GitHub. remaining is None until the first response"""
+
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self.remaining: Optional[int] = None
+        self.reset = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.remaining is None or self.remaining > 0 or now >= self.reset
+
+
+class RequestScheduler:
+    """Sends GitHub requests for the parser and the API, rotating across a pool of tokens (GITHUB_TOKENS, comma separated).
+    Each request uses the token with the most remaining budget according to the X-RateLimit-* headers. Requests only wait
+    when every token is exhausted, until the earliest reset. 403/429/5xx responses are retried with Retry-After if given,
+    otherwise with jittered exponential backoff. GET requests go through the conditional-request cache."""
+    TOKENS = os.getenv('GITHUB_TOKENS') or os.getenv('TOKEN') or '' #GITHUB_TOKENS may be set but empty, e.g. by the Dockerfile
+    MAX_RETRIES = int(os.getenv('GITHUB_MAX_RETRIES', 5))
+    BACKOFF_BASE = float(os.getenv('GITHUB_BACKOFF_BASE', 1))
+    BACKOFF_MAX = float(os.getenv('GITHUB_BACKOFF_MAX', 60))
+    RETRY_STATUSES = (403, 429, 500, 502, 503, 504)
+
+    def __init__(self, tokens: Optional[List[str]] = None, cache: Optional[HTTPCache] = None) -> None:
+        tokens = tokens if tokens is not None else [token.strip() for token in self.TOKENS.split(',') if token.strip()]
+        self.tokens = [TokenState(token) for token in tokens] or [TokenState('')] #no token means anonymous requests
+        self.cache = cache or get_cache()
+        self.requests = 0
+
+    def next_token(self) -> Tuple[Optional[TokenState], float]:
+        """Token with the largest remaining budget, or None and the number of seconds until the earliest reset"""
+        now = time.time()
+        available = [state for state in self.tokens if state.available(now)]
+        if available:
+            return max(available, key=lambda state: float('inf') if state.remaining is None else state.remaining), 0.0
+        return None, max(0.0, min(state.reset for state in self.tokens) - now)
+
+    def auth(self, state: TokenState, headers: Optional[dict]) -> dict:
+        headers = dict(headers or {})
+        if state.token:
+            headers['Authorization'] = f"Bearer {state.token}"
+        return headers
+
+    def record(self, state: TokenState, headers) -> None:
+        self.requests += 1
+        remaining, reset = headers.get('x-ratelimit-remaining'), headers.get('x-ratelimit-reset')
+        if remaining is not None:
+            state.remaining = int(remaining)
+        if reset is not None:
+            state.reset = float(reset)
+
+    def retry_delay(self, status: int, headers, text: str, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, None if the response should be returned as is"""
+        if status not in self.RETRY_STATUSES:
+            return None
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            return float(retry_after)
+        if headers.get('x-ratelimit-remaining') == '0':
+            return 0.0 #the token is marked exhausted, next_token rotates or waits for the reset
+        if status == 403 and 'rate limit' not in text.lower():
+            return None #a plain permission error, retrying will not help
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+
+    def wait_for_token(self) -> TokenState:
+        state, wait = self.next_token()
+        while state is None:
+            logging.info(f'All GitHub tokens are exhausted, waiting {wait:.0f}s for a reset...')
+            time.sleep(wait + 1)
+            state, wait = self.next_token()
+        return state
+
+    async def await_token(self) -> TokenState:
+        state, wait = self.next_token()
+        while state is None:
+            logging.info(f'All GitHub tokens are exhausted, waiting {wait:.0f}s for a reset...')
+            await asyncio.sleep(wait + 1)
+            state, wait = self.next_token()
+        return state
+
+    def request(self, session, method: str, url: str, headers: Optional[dict] = None, params: Optional[dict] = None, **kwargs) -> requests.Response:
+        """Sync request through requests (or a requests.Session). Returns the last response once it is final or retries are used up"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            state = self.wait_for_token()
+            try:
+                if method == 'GET':
+                    rsp = self.cache.get(session, url, params=params, headers=self.auth(state, headers), **kwargs)
+                else:
+                    rsp = session.request(method, url, params=params, headers=self.auth(state, headers), **kwargs)
+            except requests.RequestException as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+                logging.info(f'{method} {url} failed: {e}. Retrying in {delay:.1f}s...')
+                time.sleep(delay)
+                continue
+
+            self.record(state, rsp.headers)
+            delay = self.retry_delay(rsp.status_code, rsp.headers, rsp.text, attempt)
+            if delay is None or attempt == self.MAX_RETRIES:
+                return rsp
+            logging.info(f'{method} {url} returned {rsp.status_code}. Retrying in {delay:.1f}s...')
+            time.sleep(delay)
+
+    async def arequest(self, client: httpx.AsyncClient, method: str, url: str, headers: Optional[dict] = None, params: Optional[dict] = None, **kwargs) -> httpx.Response:
+        """Async counterpart of request, through an httpx.AsyncClient"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            state = await self.await_token()
+            try:
+                if method == 'GET':
+                    rsp = await self.cache.aget(client, url, params=params, headers=self.auth(state, headers), **kwargs)
+                else:
+                    rsp = await client.request(method, url, params=params, headers=self.auth(state, headers), **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+                logging.info(f'{method} {url} failed: {e}. Retrying in {delay:.1f}s...')
+                await asyncio.sleep(delay)
+                continue
+
+            self.record(state, rsp.headers)
+            delay = self.retry_delay(rsp.status_code, rsp.headers, rsp.text, attempt)
+            if delay is None or attempt == self.MAX_RETRIES:
+                return rsp
+            logging.info(f'{method} {url} returned {rsp.status_code}. Retrying in {delay:.1f}s...')
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'tokens': [{'remaining': state.remaining, 'reset': state.reset} for state in self.tokens]
+        }
+
+
+_scheduler = None
+
+def get_scheduler() -> RequestScheduler:
+    """Process-wide scheduler instance, created on first use"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler()
+    return _scheduler
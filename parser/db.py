@@ -1,108 +1,97 @@
 import psycopg
+from psycopg.types.json import Jsonb
 from datetime import datetime, timezone
 import logging
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple
+from common.migrations import migrate, create_history_partition, next_month
 
 class mainDB:
     """Interface for the parser to interact with the database. CONN_DETAILS represents psql connection settings in the format of "dbname= host= user= password=" """
     CONN_DETAILS = os.getenv('CONN_DETAILS')
+    RESUME_MAX_AGE = float(os.getenv('PARSER_RESUME_MAX_AGE', 6)) #hours, older unfinished runs are abandoned rather than resumed
     
     def __init__(self) -> None:
         logging.basicConfig(level=logging.INFO)
         self.conn = psycopg.connect(self.CONN_DETAILS)
         
-        with self.conn.cursor() as cursor:
-            try:
-                self.create_repositories(cursor)
-                self.create_repository_history(cursor)
-
-                self.conn.commit()
-            except Exception as e:
-                self.conn.rollback()
-                raise RuntimeError(e)
+        migrate(self.conn) #no-op unless the schema is behind
 
-    
-    def create_repositories(self, cursor):
-        try:
+    def get_unfinished_run(self) -> Optional[Tuple[int, List[str]]]:
+        """Latest run that did not commit its snapshot and is recent enough to resume, with its search result (full names by position).
+        Unfinished runs that will never be resumed (too old, or older than the resumed one) are deleted with their journaled items"""
+        with self.conn.cursor() as cursor:
             cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS repositories (
-                            repo TEXT PRIMARY KEY,
-                            owner TEXT NOT NULL,
-                            position_cur INT NOT NULL,
-                            position_prev INT,
-                            stars INT NOT NULL,
-                            watchers INT NOT NULL,
-                            forks INT NOT NULL,
-                            open_issues INT NOT NULL, 
-                            language TEXT,
-                            date_created DATE NOT NULL
-                        );
-                    """)
-        except Exception as e:
-            raise RuntimeError(f"Exception occurred when initilizing repositories {e}")
-
-    
-    def create_repository_history(self, cursor):
-        try:
+                SELECT id, repos
+                FROM parser_runs
+                WHERE finished_at IS NULL AND started_at > now() - make_interval(hours => %s)
+                ORDER BY id DESC
+                LIMIT 1;
+            """, (self.RESUME_MAX_AGE,))
+            run = cursor.fetchone()
             cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS repository_history (
-                            repo TEXT NOT NULL,
-                            position INT NOT NULL,
-                            fetch_date TIMESTAMPTZ NOT NULL,
-                            PRIMARY KEY (repo, fetch_date),
-                            FOREIGN KEY (repo) REFERENCES repositories(repo)
-                        );
-                    """)
-        except Exception as e:
-            raise RuntimeError(f"Exception occurred when initilizing repository_history: {e}")
+                DELETE FROM parser_runs
+                WHERE finished_at IS NULL
+                  AND (started_at <= now() - make_interval(hours => %s) OR id < %s);
+            """, (self.RESUME_MAX_AGE, run[0] if run else 0)) #parser_run_items cascade
+            if cursor.rowcount:
+                logging.info(f'Dropped {cursor.rowcount} abandoned parser run(s)')
+            self.conn.commit()
+            return run
     
-    def get_previous_positions(self, cursor) -> dict:
-        try:
-            cursor.execute("""
-                SELECT repo, position
-                FROM (
-                    SELECT repo, position, ROW_NUMBER() OVER (PARTITION BY repo ORDER BY fetch_date DESC) as rn
-                    FROM repository_history
-                ) as subquery
-                WHERE rn=1;
-            """)
-            previous_positions = cursor.fetchall()
-            return {row[0]: row[1] for row in previous_positions}
-        except Exception as e:
-            raise RuntimeError('Unable to get previous positions. Error: %s', e)
-
+    def start_run(self, repos: List[str]) -> int:
+        """Journals a new run with its search result, repos[i] is ranked i + 1"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("INSERT INTO parser_runs (repos) VALUES (%s) RETURNING id;", (Jsonb(repos),))
+            run_id = cursor.fetchone()[0]
+            self.conn.commit()
+            return run_id
     
-    def upsert_repositories(self, repositories: List[dict]) -> None:
-        """Upserts main table and history tables with new values. For history table, stores fetch_date in UTC"""
+    def checkpoint(self, run_id: int, items: Dict[int, dict]) -> None:
+        """Records fetched repo payloads of a run by position, a restarted run does not fetch them again"""
+        with self.conn.cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO parser_run_items (run_id, position, payload)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (run_id, position)
+                DO UPDATE SET payload = EXCLUDED.payload;
+            """, [(run_id, position, Jsonb(payload)) for position, payload in items.items()])
+            self.conn.commit()
+    
+    def get_run_items(self, run_id: int) -> Dict[int, dict]:
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT position, payload FROM parser_run_items WHERE run_id = %s;", (run_id,))
+            items = dict(cursor.fetchall())
+            self.conn.commit()
+            return items
+    
+    def upsert_repositories(self, repositories: List[dict], run_id: Optional[int] = None) -> bool:
+        """Upserts main table and history tables with new values. For history table, stores fetch_date in UTC.
+        The batch is COPYed into a temporary staging table and applied with one set-based statement per table,
+        so the number of round trips does not depend on the number of repos. If run_id is given, repos are unranked
+        against the run's search result, and the run is marked finished and its journaled payloads are dropped in the same transaction. Returns whether the snapshot was committed"""
 
         with self.conn.cursor() as cursor:
             try:
-                previous_positions = self.get_previous_positions(cursor)
-            
-                date_fetched = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z%z") #store in UTC time
+                now = datetime.now(tz=timezone.utc)
+                date_fetched = now.strftime("%Y-%m-%d %H:%M:%S %Z%z") #store in UTC time
                 
-                for repo in repositories:
-                    previous_position = previous_positions.get(repo['repo'], None) 
-                    try:
-                        cursor.execute("""
-                            INSERT INTO repositories (repo, owner, position_cur, position_prev, stars, watchers, forks, open_issues, language, date_created)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (repo)
-                            DO UPDATE SET owner = EXCLUDED.owner,
-                                        position_cur = EXCLUDED.position_cur,
-                                        position_prev = EXCLUDED.position_prev,
-                                        stars = EXCLUDED.stars,
-                                        watchers = EXCLUDED.watchers,
-                                        forks = EXCLUDED.forks,
-                                        open_issues = EXCLUDED.open_issues,
-                                        language = EXCLUDED.language,
-                                        date_created = EXCLUDED.date_created;
-                        """, (
+                #current and next month, so the partition exists before the first run of a month
+                create_history_partition(cursor, now.date())
+                create_history_partition(cursor, next_month(now.date().replace(day=1)))
+                
+                cursor.execute("""
+                    CREATE TEMP TABLE repositories_staging (LIKE repositories) ON COMMIT DROP;
+                """)
+                with cursor.copy("""
+                    COPY repositories_staging (repo, owner, position_cur, stars, watchers, forks, open_issues, language, date_created)
+                    FROM STDIN
+                """) as copy:
+                    for repo in repositories:
+                        copy.write_row((
                             repo['repo'],
                             repo['owner'],
                             repo['position_cur'],
-                            previous_position,
                             repo['stars'],
                             repo['watchers'],
                             repo['forks'],
@@ -110,27 +99,78 @@ class mainDB:
                             repo['language'],
                             repo['date_created']
                         ))
-                    except Exception as e:
-                        raise RuntimeError(f"Unable to insert into repositories. Error: {e}")
-                    
-                    try:
+                
+                try:
+                    #position_cur is always the latest history entry of a repo (both are written in this transaction), so it becomes position_prev
+                    cursor.execute("""
+                        INSERT INTO repositories (repo, owner, position_cur, position_prev, stars, watchers, forks, open_issues, language, date_created)
+                        SELECT repo, owner, position_cur, NULL::int, stars, watchers, forks, open_issues, language, date_created
+                        FROM repositories_staging
+                        ON CONFLICT (repo)
+                        DO UPDATE SET owner = EXCLUDED.owner,
+                                    position_prev = repositories.position_cur,
+                                    position_cur = EXCLUDED.position_cur,
+                                    stars = EXCLUDED.stars,
+                                    watchers = EXCLUDED.watchers,
+                                    forks = EXCLUDED.forks,
+                                    open_issues = EXCLUDED.open_issues,
+                                    language = EXCLUDED.language,
+                                    date_created = EXCLUDED.date_created;
+                    """)
+                except Exception as e:
+                    raise RuntimeError(f"Unable to insert into repositories. Error: {e}")
+                
+                try:
+                    #repos that dropped out of the top keep their rows (commit activity references them) but lose their position.
+                    #With a run, the top is its search result: a ranked repo whose details could not be fetched keeps its last
+                    #values and moves to its searched position, only repos missing from the search result are unranked
+                    if run_id is not None:
                         cursor.execute("""
-                            INSERT INTO repository_history (repo, fetch_date, position)
-                            VALUES (%s, %s, %s)
-                            ON CONFLICT (repo, fetch_date)
-                            DO NOTHING;
-                        """, (
-                            repo['repo'], 
-                            date_fetched, 
-                            repo['position_cur']
-                        ))
-                    except Exception as e:
-                        raise RuntimeError(f"Unable to insert into repository_history. Error: {e}")
-                    
+                            UPDATE repositories
+                            SET position_prev = repositories.position_cur, position_cur = ranked.position
+                            FROM parser_runs, jsonb_array_elements_text(parser_runs.repos) WITH ORDINALITY AS ranked(repo, position)
+                            WHERE parser_runs.id = %s
+                              AND repositories.repo = ranked.repo
+                              AND repositories.repo NOT IN (SELECT repo FROM repositories_staging);
+                        """, (run_id,))
+                        cursor.execute("""
+                            UPDATE repositories
+                            SET position_prev = position_cur, position_cur = NULL
+                            WHERE position_cur IS NOT NULL
+                              AND repo NOT IN (SELECT jsonb_array_elements_text(repos) FROM parser_runs WHERE id = %s);
+                        """, (run_id,))
+                    else:
+                        cursor.execute("""
+                            UPDATE repositories
+                            SET position_prev = position_cur, position_cur = NULL
+                            WHERE position_cur IS NOT NULL
+                              AND repo NOT IN (SELECT repo FROM repositories_staging);
+                        """)
+                except Exception as e:
+                    raise RuntimeError(f"Unable to unrank repositories. Error: {e}")
+                
+                try:
+                    cursor.execute("""
+                        INSERT INTO repository_history (repo, fetch_date, position)
+                        SELECT repo, %s::timestamptz, position_cur
+                        FROM repositories_staging
+                        ON CONFLICT (repo, fetch_date)
+                        DO NOTHING;
+                    """, (date_fetched,))
+                except Exception as e:
+                    raise RuntimeError(f"Unable to insert into repository_history. Error: {e}")
+                
+                if run_id is not None:
+                    cursor.execute("UPDATE parser_runs SET finished_at = now(), fetched = %s WHERE id = %s;", (len(repositories), run_id))
+                    cursor.execute("DELETE FROM parser_run_items WHERE run_id = %s;", (run_id,))
+                
+                cursor.execute("NOTIFY repositories_changed;") #delivered on commit, drops cached API responses
                 self.conn.commit()
+                return True
             except Exception as e:
                 self.conn.rollback()
                 logging.info(e)
+                return False
                 
     def close(self):
         self.conn.close()
@@ -1,114 +1,314 @@
-from time import sleep
+import asyncio
+import time
 import requests
-from requests.exceptions import HTTPError
+import httpx
 import logging
 from dateutil.parser import isoparse
 from parser.db import mainDB
+from common.http_cache import get_cache
+from common.scheduler import get_scheduler
 from sys import exit
+from typing import Callable, Dict, List, Optional, Tuple
 import os
 
 
 class Top100Getter:
-    TOKEN = os.getenv('TOKEN')
-    BASE_URL = 'https://api.github.com'
+    """Tokens, rate limits and retries are handled by the shared RequestScheduler (GITHUB_TOKENS)"""
+    BASE_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+    GRAPHQL_URL = os.getenv('GITHUB_GRAPHQL_URL', f'{BASE_URL}/graphql')
+    SEARCH_QUERY = 'stars:{low}..{high}'
+    TOP_N = int(os.getenv('TOP_N', 100)) #number of repos tracked
+    STAR_FLOOR = int(os.getenv('PARSER_STAR_FLOOR', 1000)) #repos below this many stars are never searched
+    SEARCH_CAP = 1000 #GitHub search returns at most this many results per query, REST and GraphQL alike
     HEADERS= {'X-GitHub-Api-Version': '2022-11-28',
                     'accept': 'application/vnd.github+json',
-                    'User-Agent': 'jbcorel',
-                    'Authorization': f"Bearer {TOKEN}"
+                    'User-Agent': 'jbcorel'
                 }
+    CONCURRENCY = int(os.getenv('PARSER_CONCURRENCY', 5)) #max in-flight requests, keep low to stay under secondary rate limits
+    TIMEOUT = float(os.getenv('PARSER_TIMEOUT', 10)) #per-request timeout in seconds
+    MODE = os.getenv('PARSER_MODE', 'rest') #'rest' or 'graphql'
+    ATTEMPTS = int(os.getenv('PARSER_ATTEMPTS', 3)) #per repo, then the repo is skipped for this run
+    RETRY_DELAY = float(os.getenv('PARSER_RETRY_DELAY', 5)) #seconds, multiplied by the attempt number
+    MIN_FETCHED = float(os.getenv('PARSER_MIN_FETCHED', 0.9)) #share of the search result that must be fetched to commit the snapshot
+    
+    GRAPHQL_QUERY = """
+        query($q: String!, $first: Int!, $after: String) {
+            search(query: $q, type: REPOSITORY, first: $first, after: $after) {
+                pageInfo { hasNextPage endCursor }
+                nodes {
+                    ... on Repository {
+                        nameWithOwner
+                        owner { login }
+                        stargazerCount
+                        watchers { totalCount }
+                        forkCount
+                        issues(states: OPEN) { totalCount }
+                        pullRequests(states: OPEN) { totalCount }
+                        primaryLanguage { name }
+                        createdAt
+                    }
+                }
+            }
+        }
+    """
     
     def __init__(self) -> None:
         logging.basicConfig(level=logging.INFO)
         
-    def getTop100Repos(self) -> dict:
-        """Gets a list of top100 repos. Due to the way github search api yields info, once this is done,
+    def collectTop(self, searchWindow, key, limit) -> list:
+        """Collects the `limit` most starred repos past the search cap. Each window is one search sorted by stars,
+        which reaches at most SEARCH_CAP results, the next window is capped at the star count of the last result.
+        That count is included again so ties are not lost, repeated repos are dropped. key(item) gives (full name, stars)"""
+        top, seen, high = [], set(), '*'
+        while len(top) < limit:
+            received, new, lastStars = 0, 0, None
+            for item in searchWindow(self.SEARCH_QUERY.format(low=self.STAR_FLOOR, high=high)):
+                received += 1
+                name, lastStars = key(item)
+                if name not in seen:
+                    seen.add(name)
+                    top.append(item)
+                    new += 1
+                    if len(top) == limit:
+                        break
+            if received < self.SEARCH_CAP or lastStars is None:
+                break #the window held every remaining repo above STAR_FLOOR
+            #more than SEARCH_CAP repos with the same star count would repeat the window forever, skip past them
+            high = lastStars if new else lastStars - 1
+            if high < self.STAR_FLOOR:
+                break
+            logging.info(f'Collected {len(top)} repos, next search window is {self.STAR_FLOOR}..{high} stars')
+        return top
+    
+    def searchWindowRest(self, query):
+        """Yields search items of one query, most starred first, page by page until the window ends"""
+        for page in range(1, self.SEARCH_CAP // 100 + 1):
+            params = {"q": query, 
+                      "sort": "stars", 
+                      "order": "desc", 
+                      "per_page": 100,
+                      "page": page}
+            rsp = get_scheduler().request(requests, 'GET', f"{self.BASE_URL}/search/repositories", 
+                                          params=params,
+                                          headers=self.HEADERS,
+                                          timeout=self.TIMEOUT)
+            rsp.raise_for_status()
+            items = rsp.json()['items']
+            yield from items
+            if len(items) < 100:
+                return
+    
+    def getTopRepos(self, limit=None) -> list:
+        """Gets a list of the top TOP_N repos. Due to the way github search api yields info, once this is done,
         each entry needs to be traversed to get the count of watchers, because subscribers_count is not included
         in the keys of each entry. watchers_count, watchers, startgazers_count all refer to the same thing - stargazers"""
-        
-        logging.info('Trying to get top 100 repos, starting...')
-        params = {"q": "stars:>50000", 
-                  "sort": "stars", 
-                  "order": "desc", 
-                  "per_page": 100}
-        
-        rsp = requests.get(f"{self.BASE_URL}/search/repositories", 
-                            params=params,
-                            headers=self.HEADERS)
-        
-        while not rsp.ok:
-            ##is okay for now, but then needs to indicate a client about an error
-            logging.info('Unable to get top 100 repos, retrying...')
-            sleep(5)
-            rsp = requests.get(f"{self.BASE_URL}/search/repositories?q=stars:>=50000&order=desc$page=1&per_page=100",
-                               headers=self.HEADERS).json()
-            
-        return rsp.json()['items']
+        limit = limit or self.TOP_N
+        logging.info(f'Trying to get top {limit} repos, starting...')
+        return self.collectTop(self.searchWindowRest, lambda item: (item['full_name'], item['stargazers_count']), limit)
     
     def getRepoDetails(self, owner, repo) -> dict:
-        """Get detailed description for each repo in top100"""
+        """Get detailed description for each repo in the top"""
         logging.info(f'Fetching details for repo {owner}/{repo}...')
 
-        t = 1
-        while True:
-            sleep(t)
-            try:
-                rsp = requests.get(f'{self.BASE_URL}/repos/{owner}/{repo}', headers=self.HEADERS)
-                rsp.raise_for_status()
-                break
-            except HTTPError as e:
-                logging.info(f'an HTTP error occurred while fetching details for repo {owner}/{repo}: {e}. Retrying...')
-                t = t + 1
-            except Exception as e:
-                logging.info(f'an error occurred while fetching details for repo {owner}/{repo}: {e}. Retrying...')
-                t = t + 1
-        rsp = rsp.json()
-        repo = rsp['full_name']
-        owner = rsp['owner']['login']
-        stars = rsp['stargazers_count']
-        watchers = rsp['subscribers_count']
-        forks = rsp['forks_count']
-        open_issues = rsp['open_issues']
-        language = rsp['language']
-        date_created = isoparse(rsp['created_at']).strftime('%Y-%m-%d')
-        
+        rsp = get_scheduler().request(requests, 'GET', f'{self.BASE_URL}/repos/{owner}/{repo}', headers=self.HEADERS, timeout=self.TIMEOUT)
+        rsp.raise_for_status()
+        return self.repoDetailsFromJson(rsp.json())
+    
+    @staticmethod
+    def repoDetailsFromJson(rsp: dict) -> dict:
+        """Maps a /repos/{owner}/{repo} payload onto the dict schema expected by mainDB.upsert_repositories"""
         return {
-            'repo': repo,
-            'owner': owner,
-            'stars': stars,
-            'watchers': watchers,
-            'forks': forks,
-            'open_issues': open_issues,
-            'language': language,
-            'date_created': date_created
+            'repo': rsp['full_name'],
+            'owner': rsp['owner']['login'],
+            'stars': rsp['stargazers_count'],
+            'watchers': rsp['subscribers_count'],
+            'forks': rsp['forks_count'],
+            'open_issues': rsp['open_issues'],
+            'language': rsp['language'],
+            'date_created': isoparse(rsp['created_at']).strftime('%Y-%m-%d')
         }
+    
+    async def getRepoDetailsAsync(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, owner, repo) -> dict:
+        """Async counterpart of getRepoDetails. The semaphore caps the number of requests in flight"""
+        async with semaphore:
+            rsp = await get_scheduler().arequest(client, 'GET', f'/repos/{owner}/{repo}')
+        rsp.raise_for_status()
+        return self.repoDetailsFromJson(rsp.json())
+    
+    async def fetchDetailsAsync(self, targets: List[Tuple[int, str]], checkpoint: Optional[Callable[[int, dict], None]] = None) -> Dict[int, dict]:
+        """Concurrent version of fetchDetails. All requests share one keep-alive connection pool,
+        at most CONCURRENCY of them are in flight at any time. Repos are checkpointed in completion order"""
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        limits = httpx.Limits(max_connections=self.CONCURRENCY, max_keepalive_connections=self.CONCURRENCY)
+        
+        async def fetch(position, repo_full_name) -> Tuple[int, Optional[dict]]:
+            owner, repo = repo_full_name.split('/', 1)
+            for attempt in range(1, self.ATTEMPTS + 1):
+                try:
+                    return position, await self.getRepoDetailsAsync(client, semaphore, owner, repo)
+                except Exception as e:
+                    if not self.retryOrSkip(repo_full_name, attempt, e):
+                        return position, None
+                    await asyncio.sleep(self.RETRY_DELAY * attempt)
         
-    def parser(self, delay=1) -> list:
-        """Retrieve top 100 repos, then traverse an object with top 100 repos to get detailed info on each. A delay is meant to avoid 403 for too frequent requests"""
+        details = {}
+        async with httpx.AsyncClient(base_url=self.BASE_URL,
+                                     headers=self.HEADERS,
+                                     limits=limits,
+                                     timeout=self.TIMEOUT) as client:
+            for task in asyncio.as_completed([fetch(position, repo) for position, repo in targets]):
+                position, repoDetails = await task
+                if repoDetails is not None:
+                    details[position] = repoDetails
+                    if checkpoint:
+                        checkpoint(position, repoDetails) #one short insert, blocking the loop for it is fine
+        return details
+    
+    def retryOrSkip(self, repo_full_name, attempt, error) -> bool:
+        """Bounded retry policy on top of the scheduler's own retries: a repo that still fails after ATTEMPTS is skipped, not fatal"""
+        if attempt < self.ATTEMPTS:
+            logging.info(f'Fetching details for repo {repo_full_name} failed ({attempt}/{self.ATTEMPTS}): {error}. Retrying...')
+            return True
+        logging.error(f'Skipping repo {repo_full_name} after {self.ATTEMPTS} failed attempts: {error}')
+        return False
+    
+    def fetchDetails(self, targets: List[Tuple[int, str]], checkpoint: Optional[Callable[[int, dict], None]] = None) -> Dict[int, dict]:
+        """Details of (position, full name) targets by position, each passed to checkpoint once fetched. Repos that keep failing are left out.
+        Runs the concurrent fetch engine unless PARSER_CONCURRENCY is set to 1"""
+        if self.CONCURRENCY > 1:
+            details = asyncio.run(self.fetchDetailsAsync(targets, checkpoint))
+        else:
+            details = {}
+            for position, repo_full_name in targets:
+                owner, repo = repo_full_name.split('/', 1)
+                for attempt in range(1, self.ATTEMPTS + 1):
+                    try:
+                        details[position] = self.getRepoDetails(owner, repo)
+                    except Exception as e:
+                        if not self.retryOrSkip(repo_full_name, attempt, e):
+                            break
+                        time.sleep(self.RETRY_DELAY * attempt)
+                        continue
+                    if checkpoint:
+                        checkpoint(position, details[position])
+                    logging.info(f'Successfully fetched details for repo {repo_full_name}')
+                    break
         
-        repos = self.getTop100Repos() 
+        logging.info(f'HTTP cache stats: {get_cache().stats()}, scheduler stats: {get_scheduler().stats()}')
+        return details
+    
+    @staticmethod
+    def rank(details: Dict[int, dict]) -> list:
+        """Snapshot ordered by position. Skipped repos leave a gap instead of shifting everyone below them up"""
         top100Arr = []
-        sleep(delay)
-        for position, entry in enumerate(repos, start=1):
-            owner, repo = entry['owner']['login'], entry['name']
-            
-            try:
-                repoDetails = self.getRepoDetails(owner, repo)
-            except Exception as e:
-                logging.info(f'An unknown error occured while fetching details for repo {owner}/{repo}: {e}. Retrying...')
-                exit() ##stop the parser if something bad be happening
-                    
-            repoDetails.update({'position_cur': position})
+        for position in sorted(details):
+            repoDetails = dict(details[position], position_cur=position)
             top100Arr.append(repoDetails)
-            logging.info(f'Successfully fetched details for repo {owner}/{repo}')
+        logging.info(f'Successfully fetched details for {len(top100Arr)} repos')
+        return top100Arr
+        
+    @staticmethod
+    def repoDetailsFromGraphql(node: dict) -> dict:
+        """Maps a GraphQL Repository node onto the same dict schema as repoDetailsFromJson.
+        REST open_issues counts open pull requests as well, so both connections are summed"""
+        return {
+            'repo': node['nameWithOwner'],
+            'owner': node['owner']['login'],
+            'stars': node['stargazerCount'],
+            'watchers': node['watchers']['totalCount'],
+            'forks': node['forkCount'],
+            'open_issues': node['issues']['totalCount'] + node['pullRequests']['totalCount'],
+            'language': node['primaryLanguage']['name'] if node['primaryLanguage'] else None,
+            'date_created': isoparse(node['createdAt']).strftime('%Y-%m-%d')
+        }
+    
+    def searchWindowGraphql(self, query):
+        """GraphQL counterpart of searchWindowRest, yields repos already mapped by repoDetailsFromGraphql"""
+        after = None
+        while True:
+            variables = {"q": f"{query} sort:stars-desc",
+                         "first": 100,
+                         "after": after}
+            rsp = get_scheduler().request(requests, 'POST', self.GRAPHQL_URL,
+                                          json={"query": self.GRAPHQL_QUERY, "variables": variables},
+                                          headers=self.HEADERS,
+                                          timeout=self.TIMEOUT)
+            rsp.raise_for_status()
+            payload = rsp.json()
+            if payload.get('errors'):
+                raise RuntimeError(f"GraphQL search failed: {payload['errors']}")
+            
+            search = payload['data']['search']
+            for node in search['nodes']:
+                yield self.repoDetailsFromGraphql(node)
             
-        return top100Arr 
+            if not search['pageInfo']['hasNextPage']:
+                return
+            after = search['pageInfo']['endCursor']
+    
+    def parserGraphql(self, limit=None) -> list:
+        """Alternative to parser that gets the whole top with batched GraphQL search queries,
+        100 repos per round trip, instead of one search call plus a REST call per repo"""
+        limit = limit or self.TOP_N
+        logging.info(f'Trying to get top {limit} repos via GraphQL, starting...')
+        topArr = self.collectTop(self.searchWindowGraphql, lambda repoDetails: (repoDetails['repo'], repoDetails['stars']), limit)
+        for position, repoDetails in enumerate(topArr, start=1):
+            repoDetails.update({'position_cur': position})
+        
+        logging.info(f'Successfully fetched details for {len(topArr)} repos')
+        return topArr
+    
+    def parser(self) -> list:
+        """Retrieve top TOP_N repos, then traverse an object with the top repos to get detailed info on each.
+        Uses the GraphQL batch mode if PARSER_MODE=graphql. Nothing is journaled, see run for resumable runs"""
+        
+        if self.MODE == 'graphql':
+            return self.parserGraphql()
+        
+        repos = self.getTopRepos()
+        return self.rank(self.fetchDetails([(position, entry['full_name']) for position, entry in enumerate(repos, start=1)]))
+    
+    def run(self, db: mainDB) -> bool:
+        """Journaled parser run: the search result and every fetched repo are checkpointed in parser_runs/parser_run_items,
+        so a restarted run resumes the latest unfinished one and only fetches what is missing. The snapshot is committed
+        and the run marked finished in one transaction, unless fewer than MIN_FETCHED of the searched repos were fetched:
+        the run is then left unfinished for the next one to resume. Returns whether the snapshot was committed"""
+        run = db.get_unfinished_run()
+        if run is not None:
+            run_id, repos = run
+            logging.info(f'Resuming parser run {run_id}')
+        elif self.MODE == 'graphql':
+            top100Arr = self.parserGraphql() #one batch, journaled so a failed commit is not fetched again
+            repos = [repoDetails['repo'] for repoDetails in top100Arr]
+            if not repos:
+                logging.error('Search returned no repos, nothing to commit')
+                return False
+            run_id = db.start_run(repos)
+            db.checkpoint(run_id, {repoDetails['position_cur']: repoDetails for repoDetails in top100Arr})
+        else:
+            repos = [entry['full_name'] for entry in self.getTopRepos()]
+            if not repos:
+                logging.error('Search returned no repos, nothing to commit')
+                return False
+            run_id = db.start_run(repos)
+        
+        details = db.get_run_items(run_id)
+        targets = [(position, repo) for position, repo in enumerate(repos, start=1) if position not in details]
+        if targets:
+            logging.info(f'Parser run {run_id}: {len(details)} repos checkpointed, fetching {len(targets)}')
+            details.update(self.fetchDetails(targets, lambda position, repoDetails: db.checkpoint(run_id, {position: repoDetails})))
+        
+        if not details or len(details) < self.MIN_FETCHED * len(repos):
+            logging.error(f'Parser run {run_id}: fetched {len(details)} of {len(repos)} repos, below PARSER_MIN_FETCHED={self.MIN_FETCHED}. '
+                          'Not committing, the next run resumes this one')
+            return False
+        return db.upsert_repositories(self.rank(details), run_id=run_id)
     
 
-# if __name__ == "__main__":
-#     db = mainDB()
-#     parser = Top100Getter(mainDB)
-#     top100Arr = parser.parser()
-#     db.upsert_repositories(top100Arr)
-#     db.close()
-    
-    
\ No newline at end of file
+if __name__ == "__main__":
+    db = mainDB()
+    try:
+        if not Top100Getter().run(db):
+            exit(1)
+    finally:
+        db.close()